@@ -22,8 +22,16 @@ import re
 import os
 import web
 import jwt
+import hmac
 import json
+import time
+import hashlib
+import itertools
+from functools import lru_cache
 from aux import logger_instance, debug_mode, get_input
+from cache import LRUCache
+from dbtypes import SQLArray
+from dbpool import PooledPostgresDB, RoutedDB
 from errors import (Error, InternalError, NotFound, NoMethod, NORESULT,
                     BADFILTERS, UNAUTHORIZED, FORBIDDEN, FATAL)
 
@@ -42,23 +50,51 @@ if not JWT_DISABLED and not SECRET_KEY:
     logger.error("API authentication is not configured. "
                  "You must set JWT_DISABLED or SECRET_KEY")
     raise Error(FATAL)
+# cache of verified tokens, a size of 0 disables it
+token_cache = LRUCache('token_cache',
+                       maxsize=int(os.getenv('TOKEN_CACHE_SIZE', 1024)),
+                       ttl=int(os.getenv('TOKEN_CACHE_TTL', 300)))
 
 # Define routes
 urls = (
     "/translate(/?)", "translator.Translator",
     "/works(/?)", "worksctrl.WorksController",
+    "/works/bulk(/?)", "bulkctrl.BulkWorksController",
     "/titles(/?)", "titlesctrl.TitlesController",
     "/uris(/?)", "urisctrl.UrisController",
     "/work_types(/?)", "typesctrl.TypesController",
-    "/work_relations(/?)", "relationsctrl.RelationsController"
+    "/work_relations(/?)", "relationsctrl.RelationsController",
+    "/export(/?)", "exportctrl.ExportController",
+    "/metrics(/?)", "metricsctrl.MetricsController"
 )
 
 try:
-    db = web.database(dbn='postgres',
-                      host=os.environ['IDENTIFIERSDB_HOST'],
-                      user=os.environ['IDENTIFIERSDB_USER'],
-                      pw=os.environ['IDENTIFIERSDB_PASS'],
-                      db=os.environ['IDENTIFIERSDB_DB'])
+    pool_settings = dict(
+        user=os.environ['IDENTIFIERSDB_USER'],
+        pw=os.environ['IDENTIFIERSDB_PASS'],
+        db=os.environ['IDENTIFIERSDB_DB'],
+        connect_timeout=int(os.getenv('DB_CONNECT_TIMEOUT', 10)),
+        minconn=int(os.getenv('DB_POOL_MIN', 1)),
+        maxconn=int(os.getenv('DB_POOL_MAX', 10)),
+        max_idle=int(os.getenv('DB_POOL_MAX_IDLE', 300)),
+        max_age=int(os.getenv('DB_POOL_MAX_AGE', 3600)),
+        check_after=int(os.getenv('DB_POOL_CHECK_AFTER', 30)),
+        timeout=int(os.getenv('DB_POOL_TIMEOUT', 10)))
+    primary = PooledPostgresDB(host=os.environ['IDENTIFIERSDB_HOST'],
+                               **pool_settings)
+    # optional read replicas, as a comma separated list of host[:port]
+    replicas = []
+    replica_hosts = os.getenv('IDENTIFIERSDB_REPLICAS', '')
+    for i, address in enumerate(filter(None, replica_hosts.split(','))):
+        host, _, port = address.strip().partition(':')
+        replica_settings = dict(pool_settings, host=host,
+                                name='db_replica%d_pool' % (i))
+        if port:
+            replica_settings['port'] = int(port)
+        replicas.append(PooledPostgresDB(**replica_settings))
+    db = RoutedDB(primary, replicas,
+                  policy=os.getenv('DB_REPLICA_POLICY', RoutedDB.ROUND_ROBIN),
+                  retry_after=int(os.getenv('DB_REPLICA_RETRY', 30)))
 except Exception as error:
     logger.error(error)
     raise
@@ -80,42 +116,104 @@ def api_response(fn):
 def json_response(fn):
     """JSON decorator"""
     def response(self, *args, **kw):
-        web.header('Content-Type', 'application/json;charset=UTF-8')
-        web.header('Access-Control-Allow-Origin',
-                   '"'.join([os.environ['ALLOW_ORIGIN']]))
-        web.header('Access-Control-Allow-Credentials', 'true')
-        web.header('Access-Control-Allow-Headers',
-                   'Authorization, x-test-header, Origin, '
-                   'X-Requested-With, Content-Type, Accept')
+        set_headers('application/json;charset=UTF-8')
         return json.dumps(fn(self, *args, **kw), ensure_ascii=False)
     return response
 
 
+def ndjson_response(fn):
+    """Newline delimited JSON decorator, streaming each element yielded.
+
+    Headers are set once the first element has been produced, so that errors
+    raised until then are sent with their own headers only.
+    """
+    def response(self, *args, **kw):
+        elements = iter(fn(self, *args, **kw))
+        first = list(itertools.islice(elements, 1))
+        set_headers('application/x-ndjson;charset=UTF-8')
+        for element in itertools.chain(first, elements):
+            yield json.dumps(element, ensure_ascii=False) + "\n"
+    return response
+
+
+def set_headers(content_type):
+    web.header('Content-Type', content_type)
+    web.header('Access-Control-Allow-Origin',
+               '"'.join([os.environ['ALLOW_ORIGIN']]))
+    web.header('Access-Control-Allow-Credentials', 'true')
+    web.header('Access-Control-Allow-Headers',
+               'Authorization, x-test-header, Origin, '
+               'X-Requested-With, Content-Type, Accept')
+
+
+def read_only(fn):
+    """Decorator marking a request that does not write to the database, so
+    that its queries may run on a read replica (GET requests always may)"""
+    def response(self, *args, **kw):
+        web.ctx.read_only = True
+        return fn(self, *args, **kw)
+    return response
+
+
 def check_token(fn):
     """Decorator to act as middleware, checking authentication token"""
     def response(self, *args, **kw):
         if not JWT_DISABLED:
-            intoken = get_token_from_header()
-            try:
-                jwt.decode(intoken, SECRET_KEY)
-            except jwt.exceptions.DecodeError:
-                raise Error(FORBIDDEN)
-            except jwt.ExpiredSignatureError:
-                raise Error(UNAUTHORIZED, msg="Signature expired.")
-            except jwt.InvalidTokenError:
-                raise Error(UNAUTHORIZED, msg="Invalid token.")
+            verify_token(get_token_from_header())
         return fn(self, *args, **kw)
     return response
 
 
+def verify_token(intoken):
+    """Verify a token, unless it has already been verified.
+
+    Verified tokens are cached until they expire (or for TOKEN_CACHE_TTL
+    seconds if they do not), keyed by an HMAC of the token with the secret
+    key - so that entries cannot match once the secret has been rotated.
+    """
+    key = hmac.new(SECRET_KEY.encode('utf-8'), intoken.encode('utf-8'),
+                   hashlib.sha256).hexdigest()
+    if token_cache.get(key):
+        return
+    try:
+        payload = jwt.decode(intoken, SECRET_KEY)
+    except jwt.exceptions.DecodeError:
+        raise Error(FORBIDDEN)
+    except jwt.ExpiredSignatureError:
+        raise Error(UNAUTHORIZED, msg="Signature expired.")
+    except jwt.InvalidTokenError:
+        raise Error(UNAUTHORIZED, msg="Invalid token.")
+    ttl = None
+    if isinstance(payload, dict) and 'exp' in payload:
+        ttl = int(payload['exp'] - time.time())
+        if ttl <= 0:
+            return
+    token_cache.set(key, True, ttl=ttl)
+
+
 def get_token_from_header():
     bearer = web.ctx.env.get('HTTP_AUTHORIZATION')
     return bearer.replace("Bearer ", "") if bearer else ""
 
 
 def build_parms(filters):
+    """Compile filters into an SQL clause and its parameters.
+
+    Each kind of filter is compiled to `AND attribute = ANY($attribute)`, so
+    the clause only depends on the kinds of filter used, not on the number
+    of values, which keeps queries' text (and plan) stable. Parsing is
+    cached, but the values filtered are checked on every call, as the known
+    work types and URI schemes may change.
+    """
+    clause, params, types, schemes = parse_filters(filters)
+    validate_filter_values(types, schemes)
+    return clause, dict(params)
+
+
+@lru_cache(maxsize=1024)
+def parse_filters(filters):
     if not filters:
-        return "", {}
+        return "", {}, (), ()
     # split by ',' except those preceeded by a top level domain, which will
     # be a tag URI scheme (e.g. tag:openbookpublishers.com,2009)
     params  = re.split(r"(?<!\.[a-z]{3}),", filters)
@@ -138,8 +236,9 @@ def build_parms(filters):
         except BaseException:
             raise Error(BADFILTERS, msg="Unknown filter '%s'" % (p))
 
-    process = {"work_type": types, "uri_scheme": schemes, "canonical": canoncl}
-    for key, values in list(process.items()):
+    process = [("work_type", types), ("uri_scheme", schemes),
+               ("canonical", canoncl)]
+    for key, values in process:
         if len(values) > 0:
             try:
                 andclause, ops = build_clause(key, values)
@@ -148,26 +247,35 @@ def build_parms(filters):
             except BaseException:
                 raise Error(BADFILTERS)
 
-    return clause, options
+    return clause, options, tuple(types), tuple(schemes)
+
+
+def validate_filter_values(types, schemes):
+    """Check filtered work types and URI schemes against the known ones"""
+    from models.worktype import WorkType
+    from models.urischeme import UriScheme
+    for value in types:
+        if value not in WorkType.values:
+            raise Error(BADFILTERS, msg="Unknown work type '%s'" % (value))
+    for value in schemes:
+        if value not in UriScheme.values:
+            raise Error(BADFILTERS, msg="Unknown URI scheme '%s'" % (value))
 
 
 def build_clause(attribute, values):
-    params = {}
-    clause = " AND " + attribute + " IN ("
-    no = 1
-    for v in values:
-        params[attribute + str(no)] = v
-        if no > 1:
-            clause += ","
-        clause += "$" + attribute + str(no)
-        no += 1
-    return [clause + ")", params]
+    params = {attribute: SQLArray(values)}
+    clause = " AND " + attribute + " = ANY($" + attribute + ")"
+    return [clause, params]
 
 
-if __name__ == "__main__":
-    logger.info("Starting API...")
+def create_app():
     app = web.application(urls, globals())
     app.internalerror = InternalError
     app.notfound = NotFound
     app.nomethod = NoMethod
-    app.run()
+    return app
+
+
+if __name__ == "__main__":
+    logger.info("Starting API...")
+    create_app().run()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compile the works of the database into a snapshot file.
+
+Usage: python build_snapshot.py FILE
+
+Writes a read-only, memory-mappable file with every work, its titles and
+URIs, and a sorted index of the URIs, replacing FILE atomically. API
+processes run with TRANSLATE_ENGINE=mmap and SNAPSHOT_FILE=FILE serve URI
+translations from it, picking up new versions of the file as it is rebuilt.
+"""
+
+import os
+import sys
+import time
+import argparse
+import web
+from aux import logger_instance, debug_mode
+from models import snapshotfile
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+
+def init_context():
+    """Set up the parts of the request context the models rely on"""
+    web.ctx.env     = {'REQUEST_METHOD': 'POST'}
+    web.ctx.data    = b''
+    web.ctx.status  = '200 OK'
+    web.ctx.headers = []
+
+
+def run(args):
+    init_context()
+    started = time.time()
+    snapshot = snapshotfile.compile_snapshot(args.file)
+    print("%d works, %d URIs, %d bytes written in %.1fs"
+          % (len(snapshot.numbers), len(snapshot.index),
+             os.path.getsize(args.file), time.time() - started),
+          file=sys.stderr)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compile the works of the database into a snapshot "
+                    "file.")
+    parser.add_argument('file')
+    sys.exit(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import os
+import web
+from aux import logger_instance, debug_mode
+from api import json, json_response, api_response, check_token
+from errors import Error, BADPARAMS
+from models import bulk
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+# Maximum number of records accepted by a single bulk request
+BULK_LIMIT = int(os.getenv('BULK_INGEST_LIMIT', 50000))
+
+
+class BulkWorksController():
+    """Handles bulk work ingestion"""
+
+    @json_response
+    @api_response
+    @check_token
+    def POST(self, name):
+        """Create works in bulk.
+
+        Takes a JSON array of works, or newline delimited JSON (one work per
+        line), with the same parameters as POST /works plus an optional
+        `UUID`. Records are validated one by one and all the valid ones are
+        saved in a single transaction - unless `dry_run` is set. Outputs one
+        report object per record, in the same order.
+        """
+        items = self.parse_records(web.data().decode('utf-8'))
+        if len(items) > BULK_LIMIT:
+            msg = "Bulk requests are limited to %d records" % (BULK_LIMIT)
+            raise Error(BADPARAMS, msg=msg)
+        dry_run = web.input(_method='get').get('dry_run') in ("true", "True")
+
+        # keep the response status and headers, as Error modifies them
+        status, headers = web.ctx.status, list(web.ctx.headers)
+        # errors output the request data, which can be large: we do not
+        # want it serialised for every invalid record
+        web.ctx.data = b''
+        results = bulk.validate(items)
+        web.ctx.status, web.ctx.headers = status, headers
+        if not dry_run:
+            bulk.load([work for work, _ in results if work])
+
+        return [self.report(i, work, error)
+                for i, (work, error) in enumerate(results)]
+
+    def parse_records(self, body):
+        try:
+            if body.lstrip().startswith('['):
+                items = json.loads(body)
+            else:
+                items = [json.loads(line) for line in body.splitlines()
+                         if line.strip()]
+            assert isinstance(items, list) and items
+        except Exception:
+            msg = "You must provide an array of objects or NDJSON"
+            raise Error(BADPARAMS, msg=msg)
+        return items
+
+    def report(self, index, work, error):
+        if error is not None:
+            output = {'status': 'error', 'code': error.httpcode,
+                      'message': error.message,
+                      'description': error.description}
+        else:
+            output = {'status': 'ok', 'code': 200, 'UUID': work.UUID}
+        output['index'] = index
+        return output
+
+    @json_response
+    def OPTIONS(self, name):
+        return
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from collections import OrderedDict
+import metrics
+
+
+class LRUCache():
+    """Thread safe, bounded, least recently used cache with expiring entries.
+
+    Entries may be associated with tags, invalidating a tag removes all the
+    entries associated with it. Hits, misses, evictions and invalidations
+    are reported as metrics prefixed with the name of the cache.
+    """
+
+    def __init__(self, name, maxsize=1024, ttl=0):
+        self.name    = name
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self.version = 0  # incremented on every invalidation
+        self.entries = OrderedDict()  # key -> (expiry, value, tags)
+        self.tags    = {}  # tag -> set of keys
+        self.lock    = threading.RLock()
+        for counter in ('hits', 'misses', 'evictions', 'invalidations'):
+            metrics.register_counter(self.metric(counter))
+        metrics.register_gauge(self.metric('size'), self.__len__)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def metric(self, name):
+        return '%s.%s' % (self.name, name)
+
+    def enabled(self):
+        return self.maxsize > 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expiry, value, _ = self.entries[key]
+            except KeyError:
+                metrics.increment(self.metric('misses'))
+                return default
+            if expiry and expiry < time.time():
+                self.remove(key)
+                metrics.increment(self.metric('misses'))
+                return default
+            self.entries.move_to_end(key)
+            metrics.increment(self.metric('hits'))
+            return value
+
+    def set(self, key, value, tags=[], version=None, ttl=None):
+        """Store a value, unless an invalidation has happened since `version`.
+
+        Callers computing a value that may be invalidated concurrently should
+        read self.version before computing it and pass it along, otherwise an
+        out of date value could be stored.
+        """
+        if not self.enabled():
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expiry = time.time() + ttl if ttl else 0
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (expiry, value, tags)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                oldest = next(iter(self.entries))
+                self.remove(oldest)
+                metrics.increment(self.metric('evictions'))
+
+    def remove(self, key):
+        with self.lock:
+            _, _, tags = self.entries.pop(key)
+            for tag in tags:
+                keys = self.tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.tags[tag]
+
+    def invalidate(self, *tags):
+        with self.lock:
+            self.version += 1
+            for tag in tags:
+                for key in list(self.tags.get(tag, [])):
+                    self.remove(key)
+                    metrics.increment(self.metric('invalidations'))
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+            self.tags.clear()
+
+
+class SingleFlight():
+    """Runs concurrent calls with the same key only once, sharing the result.
+
+    The first caller of a key runs the function. Callers arriving before it
+    returns wait for its result, which must be a list, and each get a copy.
+    If the function fails, each waiting caller runs it itself, so that
+    errors are raised in the context of its own request. Calls run, and
+    calls coalesced into another one, are reported as metrics prefixed with
+    the name given.
+    """
+
+    def __init__(self, name):
+        self.name    = name
+        self.flights = {}  # key -> (event, result holder)
+        self.lock    = threading.Lock()
+        for counter in ('calls', 'coalesced'):
+            metrics.register_counter('%s.%s' % (self.name, counter))
+
+    def do(self, key, fn):
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = (threading.Event(), [])
+                self.flights[key] = flight
+                leader = True
+            else:
+                leader = False
+
+        event, result = flight
+        if not leader:
+            event.wait()
+            if result:
+                metrics.increment('%s.coalesced' % (self.name))
+                return list(result[0])
+            return fn()
+
+        metrics.increment('%s.calls' % (self.name))
+        try:
+            value = fn()
+            result.append(value)
+            return value
+        finally:
+            with self.lock:
+                del self.flights[key]
+            event.set()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+PostgreSQL connection pool, plugged into web.py's database interface.
+
+Connections are checked out of the pool whenever web.py needs one and are
+returned once the query is committed or rolled back, or at the end of the
+request. Idle connections are recycled after a while, and checked before
+being reused, so that the API recovers from database restarts and
+failovers without manual intervention.
+"""
+
+import os
+import time
+import itertools
+import threading
+import web
+import psycopg2
+import metrics
+from aux import logger_instance
+
+logger = logger_instance(__name__)
+
+# statement_timeout, in milliseconds, of each class of query (0 disables it)
+STATEMENT_TIMEOUTS = {
+    'default': int(os.getenv('DB_STATEMENT_TIMEOUT', 30000)),
+    'lookup':  int(os.getenv('DB_LOOKUP_TIMEOUT', 5000)),
+    'search':  int(os.getenv('DB_SEARCH_TIMEOUT', 30000)),
+    'export':  int(os.getenv('DB_EXPORT_TIMEOUT', 0)),
+}
+
+
+def set_timeout_sql(query_class):
+    """SQL setting the statement_timeout of a class of query.
+
+    It must run in the same transaction as the query it applies to.
+    """
+    timeout = STATEMENT_TIMEOUTS.get(query_class,
+                                     STATEMENT_TIMEOUTS['default'])
+    return "SET LOCAL statement_timeout = %d; " % (timeout)
+
+
+class PoolTimeout(Exception):
+    """No connection became available in time"""
+
+
+class PooledConnection():
+    """Proxy to a pooled connection.
+
+    The connection is returned to the pool when the proxy is closed or
+    garbage collected (e.g. when web.py clears its context at the end of
+    a request).
+    """
+
+    def __init__(self, pool, connection, info):
+        self._pool = pool
+        self._connection = connection
+        self.info = info
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    @property
+    def prepared(self):
+        """Names of the statements prepared in this connection"""
+        return self.info['prepared']
+
+    def discard(self):
+        """Mark the connection so that it is not reused"""
+        self.info['broken'] = True
+
+    def detach(self):
+        """Take the connection out of the proxy, which will no longer return
+        it to the pool: the caller does, with ConnectionPool.putconn()"""
+        connection, self._connection = self._connection, None
+        return connection, self.info
+
+    def close(self):
+        if self._connection is not None:
+            self._pool.putconn(self._connection, self.info)
+            self._connection = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except BaseException:
+            pass
+
+
+class ConnectionPool():
+    """Thread safe pool of database connections.
+
+    - at most `maxconn` connections are open at once, waiting up to
+      `timeout` seconds for one to be returned when all are in use;
+    - connections idle for more than `max_idle` seconds, or open for more
+      than `max_age` seconds, are closed (keeping at least `minconn`);
+    - connections idle for more than `check_after` seconds are checked
+      with a trivial query before being reused.
+    """
+
+    def __init__(self, connect, minconn=1, maxconn=10, max_idle=300,
+                 max_age=3600, check_after=30, timeout=10, name='db_pool'):
+        self.connect     = connect
+        self.minconn     = minconn
+        self.maxconn     = maxconn
+        self.max_idle    = max_idle
+        self.max_age     = max_age
+        self.check_after = check_after
+        self.timeout     = timeout
+        self.size        = 0   # connections open, idle or in use
+        self.idle        = []  # stack of (connection, info)
+        self.condition   = threading.Condition()
+        for counter in ('created', 'discarded', 'timeouts'):
+            metrics.register_counter(name + '.' + counter)
+        metrics.register_gauge(name + '.size', lambda: self.size)
+        metrics.register_gauge(name + '.idle', lambda: len(self.idle))
+        self.name = name
+
+    @property
+    def in_use(self):
+        return self.size - len(self.idle)
+
+    def connection(self):
+        connection, info = self.getconn()
+        return PooledConnection(self, connection, info)
+
+    def getconn(self):
+        deadline = time.time() + self.timeout
+        while True:
+            with self.condition:
+                candidate = self.idle.pop() if self.idle else None
+                if candidate is None and self.size < self.maxconn:
+                    self.size += 1
+                    break
+                if candidate is None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        metrics.increment(self.name + '.timeouts')
+                        raise PoolTimeout()
+                    self.condition.wait(remaining)
+                    continue
+            # check the candidate outside the lock, it may run a query
+            if self.usable(*candidate):
+                candidate[1]['used'] = time.time()
+                return candidate
+            self.discard(candidate[0])
+
+        try:
+            connection = self.connect()
+        except BaseException:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+        metrics.increment(self.name + '.created')
+        now = time.time()
+        return connection, {'created': now, 'used': now, 'broken': False,
+                            'prepared': set()}
+
+    def usable(self, connection, info):
+        now = time.time()
+        if connection.closed or info['broken']:
+            return False
+        if now - info['created'] > self.max_age:
+            return False
+        if now - info['used'] > self.max_idle:
+            return False
+        if now - info['used'] > self.check_after:
+            try:
+                cursor = connection.cursor()
+                cursor.execute("SELECT 1")
+                connection.rollback()
+            except BaseException:
+                return False
+        return True
+
+    def putconn(self, connection, info):
+        """Return a connection to the pool, ending its transaction"""
+        try:
+            if not connection.closed and not info['broken']:
+                connection.rollback()
+        except BaseException:
+            info['broken'] = True
+        if connection.closed or info['broken']:
+            self.discard(connection)
+            return
+        info['used'] = time.time()
+        with self.condition:
+            self.idle.append((connection, info))
+            self.recycle()
+            self.condition.notify()
+
+    def recycle(self):
+        """Close connections that have been idle too long, least recent
+        first, keeping at least `minconn` open"""
+        now = time.time()
+        while self.idle and self.size > self.minconn:
+            connection, info = self.idle[0]
+            if now - info['used'] <= self.max_idle:
+                break
+            self.idle.pop(0)
+            self.size -= 1
+            self.close(connection)
+
+    def discard(self, connection):
+        self.close(connection)
+        metrics.increment(self.name + '.discarded')
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    def close(self, connection):
+        try:
+            connection.close()
+        except BaseException:
+            pass
+
+    def closeall(self):
+        with self.condition:
+            for connection, _ in self.idle:
+                self.close(connection)
+            self.size -= len(self.idle)
+            self.idle = []
+
+    def reset(self):
+        """Forget all connections without closing them.
+
+        To be used in a forked process: closing the connections inherited
+        from the parent would terminate the parent's database sessions.
+        """
+        with self.condition:
+            self.idle = []
+            self.size = 0
+
+
+class PooledPostgresDB(web.db.PostgresDB):
+    """web.py PostgreSQL database backed by a ConnectionPool.
+
+    web.py already supports pooling (through DBUtils): with `has_pooling` set
+    it checks a connection out on first use and releases its context on
+    commit and rollback, which we use to return connections to our pool.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, max_idle=300, max_age=3600,
+                 check_after=30, timeout=10, name='db_pool', **keywords):
+        timeout_ms = STATEMENT_TIMEOUTS['default']
+        keywords.setdefault('options', '-c statement_timeout=%d' % timeout_ms)
+        keywords['pooling'] = False
+        web.db.PostgresDB.__init__(self, **keywords)
+        self.has_pooling = True
+        self.pool = ConnectionPool(self._connect_raw, minconn, maxconn,
+                                   max_idle, max_age, check_after, timeout,
+                                   name)
+
+    def _connect_raw(self):
+        return web.db.PostgresDB._connect(self, self.keywords)
+
+    def _connect_with_pooling(self, keywords):
+        return self.pool.connection()
+
+    def getconn(self):
+        """Check a connection out, to be returned with pool.putconn().
+
+        The connection the current thread has already checked out, if it is
+        not in a transaction, is taken out of its context and used; another
+        one is checked out of the pool otherwise.
+        """
+        ctx = self._ctx
+        if ctx.get('db') is not None and not ctx.get('transactions'):
+            connection, info = ctx.db.detach()
+            del ctx.db
+            return connection, info
+        return self.pool.getconn()
+
+    def _load_context(self, ctx):
+        web.db.PostgresDB._load_context(self, ctx)
+
+        def rollback():
+            # a connection lost (e.g. after a failover) cannot be rolled
+            # back: release it anyway, the pool will discard it
+            try:
+                ctx.db.rollback()
+            except psycopg2.Error:
+                ctx.db.discard()
+            finally:
+                self._unload_context(ctx)
+
+        ctx.rollback = rollback
+
+    def _unload_context(self, ctx):
+        ctx.db.close()
+        del ctx.db
+
+
+class RoutedDB():
+    """Routes the queries of read-only requests to read replicas.
+
+    The database of each request is chosen on first use and kept in web.ctx:
+    GET requests, and those marked with web.ctx.read_only (see
+    api.read_only()), use one of the replicas, picked by `policy`
+    (ROUND_ROBIN or LEAST_CONNECTIONS), and every other request uses the
+    primary - so that
+    the responses of POST/PUT/DELETE requests read their own writes, as do
+    queries run outside a request. A replica that cannot be connected to is
+    skipped for `retry_after` seconds, falling back to the primary when
+    none is available.
+    """
+
+    ROUND_ROBIN       = 'round-robin'
+    LEAST_CONNECTIONS = 'least-connections'
+
+    def __init__(self, primary, replicas=[], policy=ROUND_ROBIN,
+                 retry_after=30):
+        self.primary     = primary
+        self.replicas    = list(replicas)
+        self.policy      = policy
+        self.retry_after = retry_after
+        self.down        = {}  # replica index -> time to retry it at
+        self.counter     = itertools.count()
+        metrics.register_counter('db_replicas.failovers')
+
+    def __getattr__(self, name):
+        return getattr(self.database(), name)
+
+    def database(self):
+        """Get the database to run the queries of the current request on"""
+        if 'database' not in web.ctx:
+            web.ctx.database = self.choose()
+        return web.ctx.database
+
+    def is_read_only(self):
+        if web.ctx.get('read_only'):
+            return True
+        env = web.ctx.get('env') or {}
+        return env.get('REQUEST_METHOD') == 'GET'
+
+    def candidates(self):
+        now = time.time()
+        available = [i for i in range(len(self.replicas))
+                     if self.down.get(i, 0) <= now]
+        if self.policy == self.LEAST_CONNECTIONS:
+            return sorted(available,
+                          key=lambda i: self.replicas[i].pool.in_use)
+        if not available:
+            return available
+        start = next(self.counter) % len(available)
+        return available[start:] + available[:start]
+
+    def choose(self):
+        if not self.replicas or not self.is_read_only():
+            return self.primary
+        for i in self.candidates():
+            replica = self.replicas[i]
+            try:
+                # checks a connection out, the request is going to use it
+                replica.ctx
+                return replica
+            except PoolTimeout:
+                continue
+            except Exception as error:
+                logger.error(error)
+                self.down[i] = time.time() + self.retry_after
+                metrics.increment('db_replicas.failovers')
+        return self.primary
+
+    def reset(self):
+        """Forget the connections of all pools, see ConnectionPool.reset()"""
+        for database in [self.primary] + self.replicas:
+            database.pool.reset()
+        self.down = {}
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from psycopg2.extensions import register_adapter, QuotedString
+
+
+class SQLArray(tuple):
+    """A list of values to be passed to a query as a single array parameter.
+
+    web.py expands lists into `(a, b, ...)`, which makes the text of the
+    query depend on the number of values. An SQLArray is sent as a single
+    array literal instead, to be used with `= ANY($values)`, so that queries
+    keep the same shape (and plan) whatever the number of values.
+    """
+
+
+def quote_array(array):
+    """Adapt an SQLArray as an untyped array literal (e.g. '{"a","b"}').
+
+    Leaving the literal untyped lets PostgreSQL coerce it to the type of the
+    column it is compared with (text[], uuid[], boolean[]...).
+    """
+    items = []
+    for value in array:
+        if value is None:
+            items.append('NULL')
+        else:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+            items.append('"%s"' % (value))
+    return QuotedString('{' + ','.join(items) + '}')
+
+
+register_adapter(SQLArray, quote_array)
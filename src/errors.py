@@ -14,6 +14,7 @@ FATAL        = 80
 UNAUTHORIZED = 90
 FORBIDDEN    = 100
 BADAUTH      = 110
+UNAVAILABLE  = 120
 DEFAULT      = NOTFOUND
 
 _level_messages = {
@@ -27,7 +28,8 @@ _level_messages = {
     FATAL:        'Something terrible has happened.',
     UNAUTHORIZED: 'Authentication is needed.',
     FORBIDDEN:    'You do not have permissions to access this resource.',
-    BADAUTH:      'Wrong credentials provided.'
+    BADAUTH:      'Wrong credentials provided.',
+    UNAVAILABLE:  'The service is busy, please try again later.'
 }
 
 _level_statuses = {
@@ -41,7 +43,8 @@ _level_statuses = {
     FATAL:        '500 Internal Server Error',
     UNAUTHORIZED: '401 Unauthorized',
     FORBIDDEN:    '403 Forbidden',
-    BADAUTH:      '401 Unauthorized'
+    BADAUTH:      '401 Unauthorized',
+    UNAVAILABLE:  '503 Service Unavailable'
 }
 
 _level_codes = {
@@ -55,7 +58,8 @@ _level_codes = {
     FATAL:        500,
     UNAUTHORIZED: 401,
     FORBIDDEN:    403,
-    BADAUTH:      401
+    BADAUTH:      401,
+    UNAVAILABLE:  503
 }
 
 
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Notifications of changes made to works, used to keep in-process caches and
+indexes up to date. Subscribers are called with the work_id and, where
+relevant, the list of [scheme, value] URIs and the titles involved - or,
+for changes published together, with a list of (work_id, uris, titles)
+tuples if they subscribed a function to handle them at once.
+
+Notifications are only delivered within the process that made the change.
+"""
+
+WORK_SAVED     = 'work_saved'
+WORK_DELETED   = 'work_deleted'
+URIS_DELETED   = 'uris_deleted'
+TITLES_DELETED = 'titles_deleted'
+
+_subscribers = {}
+
+
+def subscribe(event, fn, fn_many=None):
+    _subscribers.setdefault(event, []).append((fn, fn_many))
+
+
+def publish(event, work_id, uris=[], titles=[]):
+    for fn, _ in _subscribers.get(event, []):
+        fn(work_id, uris=uris, titles=titles)
+
+
+def publish_many(event, changes):
+    """Publish a list of (work_id, uris, titles) changes at once"""
+    for fn, fn_many in _subscribers.get(event, []):
+        if fn_many is not None:
+            fn_many(changes)
+            continue
+        for work_id, uris, titles in changes:
+            fn(work_id, uris=uris, titles=titles)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Export the URI to work mapping of the database.
+
+Usage: python export.py [options] [FILE]
+
+Writes one row per URI - `work_id`, `work_type`, `uri_scheme`, `uri_value`
+and `canonical`, plus `titles` with --titles - as CSV (with COPY TO) or as
+newline delimited JSON (from a server-side cursor) to FILE, or to standard
+output. FILE is gzipped if its name ends in `.gz`. With --since, only the
+URIs added since the given timestamp are exported, which requires
+`track_commit_timestamp` to be enabled in PostgreSQL.
+"""
+
+import io
+import sys
+import gzip
+import argparse
+import web
+from aux import logger_instance, debug_mode
+from models import mapping
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+
+def init_context():
+    """Set up the parts of the request context the models rely on"""
+    web.ctx.env     = {'REQUEST_METHOD': 'GET'}
+    web.ctx.data    = b''
+    web.ctx.status  = '200 OK'
+    web.ctx.headers = []
+
+
+def open_output(path):
+    if path is None or path == '-':
+        return io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8',
+                                newline='')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+def run(args):
+    init_context()
+    output = open_output(args.file)
+    try:
+        if args.format == 'csv':
+            mapping.copy_csv(output, args.since, args.titles)
+        else:
+            rows = mapping.get_mapping(args.since, args.titles)
+            for chunk in mapping.iter_ndjson(rows):
+                output.write(chunk)
+    finally:
+        output.close()
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the URI to work mapping as CSV or NDJSON.")
+    parser.add_argument('file', nargs='?',
+                        help="file to write to (gzipped if it ends in .gz), "
+                             "standard output by default")
+    parser.add_argument('--format', choices=['csv', 'ndjson'],
+                        default='ndjson')
+    parser.add_argument('--titles', action='store_true',
+                        help="include the titles of each work")
+    parser.add_argument('--since',
+                        help="only export URIs added since this timestamp")
+    sys.exit(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
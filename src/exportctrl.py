@@ -0,0 +1,82 @@
+import re
+import os
+import web
+import threading
+from aux import logger_instance, debug_mode
+from api import json_response, set_headers, check_token
+from errors import Error, BADPARAMS, UNAVAILABLE
+from models import mapping
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+# Maximum number of exports run at once by each process
+EXPORT_LIMIT = int(os.getenv('EXPORT_CONCURRENCY', 2))
+exports = threading.BoundedSemaphore(EXPORT_LIMIT)
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson;charset=UTF-8',
+    'csv':    'text/csv;charset=UTF-8'
+}
+
+# ISO 8601 date or date and time, with an optional time zone
+TIMESTAMP = re.compile(r'^\d{4}-\d{2}-\d{2}'
+                       r'([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?'
+                       r'(Z|[+-]\d{2}(:?\d{2})?)?)?$')
+
+
+class ExportController():
+    """Handles exports of the URI to work mapping"""
+
+    @check_token
+    def GET(self, name):
+        """Stream the whole URI to work mapping, one row per URI.
+
+        `format` is either `ndjson` (default) or `csv`; `titles=true` adds
+        the titles of each work; `since` (an ISO 8601 timestamp) limits the
+        export to the URIs added since then. The response is compressed on
+        the fly when the client accepts gzip.
+        """
+        params = web.input()
+        output = params.get('format', 'ndjson')
+        if output not in FORMATS:
+            msg = "Format must be one of: %s" % (', '.join(sorted(FORMATS)))
+            raise Error(BADPARAMS, msg=msg)
+        since = params.get('since') or None
+        if since is not None and not TIMESTAMP.match(since):
+            msg = "'since' must be an ISO 8601 timestamp"
+            raise Error(BADPARAMS, msg=msg)
+        titles = params.get('titles') in ("true", "True")
+
+        compress = 'gzip' in web.ctx.env.get('HTTP_ACCEPT_ENCODING', '')
+        return self.export(output, since, titles, compress)
+
+    def export(self, output, since, titles, compress):
+        # web.py reads the first chunk before sending the status and headers,
+        # so errors raised until then are still reported as such
+        if not exports.acquire(blocking=False):
+            msg = "Too many exports running, please try again later"
+            raise Error(UNAVAILABLE, msg=msg)
+        try:
+            rows = mapping.get_mapping(since, titles)
+            if output == 'csv':
+                chunks = mapping.iter_csv(rows, titles)
+            else:
+                chunks = mapping.iter_ndjson(rows)
+            if compress:
+                chunks = mapping.iter_gzip(chunks)
+            first = next(chunks, None)
+            set_headers(FORMATS[output])
+            if compress:
+                web.header('Content-Encoding', 'gzip')
+                web.header('Vary', 'Accept-Encoding')
+            if first is not None:
+                yield first
+            for chunk in chunks:
+                yield chunk
+        finally:
+            exports.release()
+
+    @json_response
+    def OPTIONS(self, name):
+        return
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+gunicorn settings: a pre-fork server running `WORKERS` processes with
+`THREADS` threads each. Send SIGHUP to the master process to gracefully
+reload the workers.
+"""
+
+import os
+import sys
+import multiprocessing
+
+bind             = '0.0.0.0:' + os.getenv('PORT', '8080')
+workers          = int(os.getenv('WORKERS', multiprocessing.cpu_count()))
+threads          = int(os.getenv('THREADS', 4))
+worker_class     = 'gthread' if threads > 1 else 'sync'
+keepalive        = int(os.getenv('KEEPALIVE', 5))
+timeout          = int(os.getenv('WORKER_TIMEOUT', 60))
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', 30))
+max_requests     = int(os.getenv('MAX_REQUESTS', 0))
+preload_app      = os.getenv('PRELOAD_APP', 'false').lower() == 'true'
+accesslog        = '-'
+
+
+def post_fork(server, worker):
+    # database connections must not be shared with the master process:
+    # each worker opens its own once it starts serving requests
+    api = sys.modules.get('api')
+    if api is not None:
+        api.db.reset()
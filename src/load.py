@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load a catalogue file into the database.
+
+Usage: python load.py [options] FILE
+
+FILE is either JSONL - one work per line, with the same attributes as
+POST /works plus an optional `UUID` - or CSV, with a header row and the
+columns `uuid` (optional), `type`, `titles`, `uris`, `canonical_uris`,
+`parents` and `children`, multiple values being separated by `|`.
+
+Works are validated like POST /works/bulk and loaded in batches, each in its
+own transaction. After every batch the position in the file is saved to the
+checkpoint file (if given), from which an interrupted load resumes. Records
+without a UUID are given one derived from the path of the file and their
+position in it, so that a batch loaded again when resuming (e.g. after a
+crash before its checkpoint was saved) updates the same works. Parents
+and children must be works of the same batch, of a previous one, or already
+stored - which is not checked on dry runs. Invalid records are written to
+the rejects file (standard error by default) as JSON lines. The works loaded
+are notified to the API processes, as when loaded through the API.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import uuid
+import argparse
+import web
+from aux import logger_instance, debug_mode
+from models import bulk
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+MULTIPLE_SEPARATOR = '|'
+
+
+def split_values(value):
+    return [v.strip() for v in (value or '').split(MULTIPLE_SEPARATOR)
+            if v.strip()]
+
+
+def csv_to_record(row):
+    canonical = set(split_values(row.get('canonical_uris')))
+    uris = split_values(row.get('uris')) + sorted(canonical)
+    record = {
+        'type': row.get('type', ''),
+        'title': split_values(row.get('titles')),
+        'uri': [{'uri': uri, 'canonical': uri in canonical}
+                for uri in sorted(set(uris), key=uris.index)],
+        'parent': split_values(row.get('parents')),
+        'child': split_values(row.get('children'))
+    }
+    if row.get('uuid'):
+        record['UUID'] = row['uuid']
+    return record
+
+
+def record_uuid(path, offset):
+    """The UUID of the record without one starting at `offset` in a file"""
+    name = 'file://%s#%d' % (os.path.realpath(path), offset)
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, name))
+
+
+def with_uuid(record, work_id):
+    if not isinstance(record, dict) or record.get('UUID') or \
+            record.get('uuid'):
+        return record
+    return dict(record, UUID=work_id)
+
+
+class Catalogue():
+    """Reads the records of a catalogue file from a given byte offset,
+    keeping track of the offsets of the record read last: where it starts,
+    and where the next one does"""
+
+    def __init__(self, path, file_format, offset=0):
+        self.file   = open(path, 'rb')
+        self.format = file_format
+        self.offset = offset
+        self.start  = offset
+        self.header = None
+        if self.format == 'csv':
+            # the header is read from the start of the file, whatever the
+            # offset to resume from
+            self.offset = 0
+            self.header = next(csv.reader(self.lines()))
+            self.offset = max(offset, self.offset)
+        self.file.seek(self.offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def lines(self):
+        for line in self.file:
+            self.offset += len(line)
+            yield line.decode('utf-8')
+
+    def __iter__(self):
+        if self.format == 'csv':
+            rows = csv.DictReader(self.lines(), self.header)
+        else:
+            rows = self.lines()
+        while True:
+            self.start = self.offset
+            row = next(rows, None)
+            if row is None:
+                return
+            if self.format == 'csv':
+                yield csv_to_record(row)
+            elif not row.strip():
+                continue
+            else:
+                try:
+                    yield json.loads(row)
+                except ValueError:
+                    # reported as an invalid record
+                    yield row.strip()
+
+
+def read_checkpoint(path):
+    state = {'offset': 0, 'records': 0, 'loaded': 0, 'rejected': 0}
+    if path and os.path.exists(path):
+        with open(path) as checkpoint:
+            state.update(json.load(checkpoint))
+    return state
+
+
+def write_checkpoint(path, state):
+    with open(path + '.tmp', 'w') as checkpoint:
+        json.dump(state, checkpoint)
+    # replace the previous checkpoint atomically
+    os.replace(path + '.tmp', path)
+
+
+def init_context():
+    """Set up the parts of the request context the models rely on"""
+    web.ctx.env     = {'REQUEST_METHOD': 'POST'}
+    web.ctx.data    = b''
+    web.ctx.status  = '200 OK'
+    web.ctx.headers = []
+
+
+def load_batch(batch, state, dry_run, rejects):
+    # relatives loaded in previous batches are only stored when not dry
+    # running, so they cannot be checked then
+    results = bulk.validate([with_uuid(record, work_id)
+                             for _, record, work_id in batch],
+                            check_stored=not dry_run)
+    if not dry_run:
+        bulk.load([work for work, _ in results if work])
+    for (number, record, _), (work, error) in zip(batch, results):
+        if error is None:
+            state['loaded'] += 1
+            continue
+        state['rejected'] += 1
+        rejects.write(json.dumps({'record': number,
+                                  'error': error.description,
+                                  'input': record}) + '\n')
+    state['records'] += len(batch)
+
+
+def run(args):
+    init_context()
+    state = read_checkpoint(args.checkpoint)
+    file_format = args.format or \
+        ('csv' if args.file.lower().endswith('.csv') else 'jsonl')
+    rejects = open(args.rejects, 'a') if args.rejects else sys.stderr
+
+    started = time.time()
+    done_before = state['records']
+    batch = []
+
+    def flush(catalogue):
+        load_batch(batch, state, args.dry_run, rejects)
+        state['offset'] = catalogue.offset
+        if args.checkpoint and not args.dry_run:
+            write_checkpoint(args.checkpoint, state)
+        elapsed = max(time.time() - started, 1e-6)
+        rate = (state['records'] - done_before) / elapsed
+        print("%d records, %d loaded, %d rejected (%.0f records/s)"
+              % (state['records'], state['loaded'], state['rejected'], rate),
+              file=sys.stderr)
+        del batch[:]
+
+    try:
+        with Catalogue(args.file, file_format, state['offset']) as catalogue:
+            for record in catalogue:
+                number = state['records'] + len(batch) + 1
+                work_id = record_uuid(args.file, catalogue.start)
+                batch.append((number, record, work_id))
+                if len(batch) >= args.batch_size:
+                    flush(catalogue)
+            if batch:
+                flush(catalogue)
+    finally:
+        if args.rejects:
+            rejects.close()
+    return 1 if state['rejected'] else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load a CSV or JSONL catalogue file into the database.")
+    parser.add_argument('file')
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help="file format, guessed from its extension "
+                             "by default")
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help="number of works loaded in each transaction")
+    parser.add_argument('--checkpoint',
+                        help="file to save progress to, and resume from")
+    parser.add_argument('--rejects',
+                        help="file to append invalid records to")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="validate the file without loading it")
+    sys.exit(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
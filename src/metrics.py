@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-process counters and gauges, exposed through the /metrics route.
+
+Values are kept per process, i.e. each API worker reports its own.
+"""
+
+import threading
+
+_lock     = threading.Lock()
+_counters = {}
+_gauges   = {}
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def register_counter(name):
+    """Make sure a counter is reported even before it is incremented"""
+    with _lock:
+        _counters.setdefault(name, 0)
+
+
+def register_gauge(name, fn):
+    """Report the value returned by `fn` whenever metrics are read"""
+    with _lock:
+        _gauges[name] = fn
+
+
+def get_all():
+    with _lock:
+        values = dict(_counters)
+        gauges = list(_gauges.items())
+    for name, fn in gauges:
+        values[name] = fn()
+    return [{'name': name, 'value': values[name]} for name in sorted(values)]
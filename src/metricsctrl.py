@@ -0,0 +1,22 @@
+import web
+import metrics
+from aux import logger_instance, debug_mode
+from api import json_response, api_response, check_token
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+
+class MetricsController():
+    """Handles metrics related actions"""
+
+    @json_response
+    @api_response
+    @check_token
+    def GET(self, name):
+        """List the counters and gauges of this process"""
+        return metrics.get_all()
+
+    @json_response
+    def OPTIONS(self, name):
+        return
@@ -0,0 +1,165 @@
+import io
+import csv
+import web
+import psycopg2
+import events
+from aux import logger_instance, debug_mode, strtolist
+from api import db
+from errors import Error, FATAL, BADPARAMS
+from .work import Work, normalise_uuid
+from . import changefeed
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+# temporary tables works are copied into, in loading order
+STAGING_TABLES = [
+    ('bulk_work', 'work_id uuid, work_type text'),
+    ('bulk_title', 'work_id uuid, title text'),
+    ('bulk_uri', '''work_id uuid, uri_scheme text, uri_value text,
+                    canonical boolean'''),
+    ('bulk_relation', 'parent_work_id uuid, child_work_id uuid')
+]
+
+# statements merging the staging tables into the actual ones
+MERGE_QUERIES = [
+    '''INSERT INTO work (work_id, work_type)
+       SELECT work_id, work_type FROM bulk_work
+       ON CONFLICT DO NOTHING''',
+    '''INSERT INTO title
+       SELECT DISTINCT title FROM bulk_title
+       ON CONFLICT DO NOTHING''',
+    '''INSERT INTO work_title (work_id, title)
+       SELECT DISTINCT work_id, title FROM bulk_title
+       ON CONFLICT DO NOTHING''',
+    '''INSERT INTO uri
+       SELECT DISTINCT uri_scheme, uri_value FROM bulk_uri
+       ON CONFLICT DO NOTHING''',
+    '''INSERT INTO work_uri (work_id, uri_scheme, uri_value, canonical)
+       SELECT DISTINCT ON (work_id, uri_scheme, uri_value)
+              work_id, uri_scheme, uri_value, canonical
+       FROM bulk_uri
+       ORDER BY work_id, uri_scheme, uri_value, canonical DESC
+       ON CONFLICT DO NOTHING''',
+    '''INSERT INTO work_relation (parent_work_id, child_work_id)
+       SELECT DISTINCT parent_work_id, child_work_id FROM bulk_relation
+       ON CONFLICT DO NOTHING'''
+]
+
+
+def validate(items, check_stored=True):
+    """Validate the records of a bulk load.
+
+    Each record takes the same parameters as POST /works, plus an optional
+    `UUID` - records with the UUID of an existing work add their titles,
+    URIs and relatives to it. Returns a list of (work, error) pairs, one per
+    record: the unsaved Work, or the Error that made the record invalid.
+
+    Parents and children must be works of the same batch or stored ones;
+    with `check_stored` set to False the latter are not checked.
+    """
+    results = []
+    seen = set()
+    for item in items:
+        try:
+            if not isinstance(item, dict):
+                raise Error(BADPARAMS, msg="Records must be objects")
+            work_id = item.get('UUID') or item.get('uuid')
+            if work_id is not None and not normalise_uuid(work_id):
+                raise Error(BADPARAMS, msg="Invalid UUID '%s'" % (work_id))
+            work = Work.from_input(item, normalise_uuid(work_id))
+            if work.UUID in seen:
+                raise Error(BADPARAMS, msg="Duplicate UUID '%s'" % (work_id))
+            relatives = {}
+            for name in ('parent', 'child'):
+                relatives[name] = strtolist(item.get(name)) or []
+                for relative in relatives[name]:
+                    if not normalise_uuid(relative):
+                        msg = "Unknown work '%s'" % (relative)
+                        raise Error(BADPARAMS, msg=msg)
+            work.set_parents([normalise_uuid(r) for r in relatives['parent']])
+            work.set_children([normalise_uuid(r) for r in relatives['child']])
+            seen.add(work.UUID)
+            results.append((work, None))
+        except Error as error:
+            results.append((None, error))
+    resolve_relatives(results, check_stored)
+    return results
+
+
+def resolve_relatives(results, check_stored=True):
+    """Invalidate records with relatives that are neither valid records of
+    the batch nor stored works"""
+    batch = set(work.UUID for work, _ in results if work)
+    external = set(relative for work, _ in results if work
+                   for relative in work.parent + work.child
+                   if relative not in batch)
+    missing = set(Work.get_missing(sorted(external))) if check_stored \
+        else set()
+    changed = True
+    while changed:
+        # invalidating a record invalidates the records related to it
+        changed = False
+        valid = set(work.UUID for work, _ in results if work)
+        for i, (work, _) in enumerate(results):
+            if work is None:
+                continue
+            invalid = (batch - valid) | missing
+            unknown = [relative for relative in work.parent + work.child
+                       if relative in invalid]
+            if unknown:
+                msg = "Unknown work '%s'" % (unknown[0])
+                results[i] = (None, Error(BADPARAMS, msg=msg))
+                changed = True
+
+
+def get_staging_rows(works):
+    """Get the rows of each staging table for the given works"""
+    rows = dict((table, []) for table, _ in STAGING_TABLES)
+    for work in works:
+        rows['bulk_work'].append((work.UUID, work.type))
+        for title in work.title:
+            rows['bulk_title'].append((work.UUID, title))
+        for i, (scheme, value) in zip(work.URI, work.get_uri_parts()):
+            rows['bulk_uri'].append((work.UUID, scheme, value,
+                                     't' if i['canonical'] else 'f'))
+        for parent in work.parent:
+            rows['bulk_relation'].append((parent, work.UUID))
+        for child in work.child:
+            rows['bulk_relation'].append((work.UUID, child))
+    return rows
+
+
+def to_csv(rows):
+    output = io.StringIO()
+    csv.writer(output).writerows(rows)
+    output.seek(0)
+    return output
+
+
+def load(works):
+    """Save works in bulk, in a single transaction.
+
+    Works are copied (with COPY) into temporary tables, which are merged
+    into the actual ones with one statement per table.
+    """
+    if not works:
+        return
+    rows = get_staging_rows(works)
+    try:
+        with db.transaction():
+            cursor = db.ctx.db.cursor()
+            for table, columns in STAGING_TABLES:
+                cursor.execute('''CREATE TEMPORARY TABLE %s (%s)
+                                  ON COMMIT DROP''' % (table, columns))
+                cursor.copy_expert('COPY %s FROM STDIN WITH (FORMAT csv)'
+                                   % (table), to_csv(rows[table]))
+            for q in MERGE_QUERIES:
+                cursor.execute(q)
+            changefeed.notify([work.UUID for work in works])
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(error)
+        raise Error(FATAL)
+    events.publish_many(events.WORK_SAVED,
+                        [(work.UUID, work.get_uri_parts(), work.title)
+                         for work in works])
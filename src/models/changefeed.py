@@ -0,0 +1,118 @@
+import time
+import select
+import threading
+import web
+from aux import logger_instance, debug_mode
+from api import db
+from dbtypes import SQLArray
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+# channel on which the works changed are notified, the payload of each
+# notification being a comma separated list of work_ids
+CHANNEL = 'work_changes'
+
+# work_ids sent in a single notification (payloads are limited to 8000 bytes)
+NOTIFY_BATCH = 200
+
+# work_ids passed to update() at once
+UPDATE_BATCH = 1000
+
+# seconds to wait before reconnecting to the change feed
+RETRY_AFTER = 5
+
+
+class ChangeFeed():
+    """Keeps an in-process copy of (part of) the database up to date.
+
+    A background thread, started on first use in each process, listens to
+    the changes notified on CHANNEL (see notify()), calls `load()`
+    once listening, and `update(work_ids)` with the works changed since.
+    `load()` is called again every `ttl` seconds (unless 0) and whenever
+    the connection is reestablished, as notifications may have been lost.
+    `listening` tells whether changes are currently being received.
+    """
+
+    def __init__(self, name, load, update, ttl=3600):
+        self.name      = name
+        self.load      = load
+        self.update    = update
+        self.ttl       = ttl
+        self.loaded_at = None
+        self.listening = False
+        self.thread    = None
+        self.lock      = threading.Lock()
+
+    def ensure_started(self):
+        """Start the background thread, in this process, if not running"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run,
+                                               name=self.name, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        # the models report errors in terms of the current request
+        web.ctx.env     = {'REQUEST_METHOD': 'POST'}
+        web.ctx.data    = b''
+        web.ctx.status  = '200 OK'
+        web.ctx.headers = []
+        while True:
+            try:
+                self.listen()
+            except Exception as error:
+                logger.error(error)
+            time.sleep(RETRY_AFTER)
+
+    def reload(self):
+        self.loaded_at = time.time()
+        self.load()
+
+    def listen(self):
+        # notifications are not replicated, they are read from the primary
+        connection = db.primary.pool.connect()
+        try:
+            connection.autocommit = True
+            connection.cursor().execute('LISTEN %s' % (CHANNEL))
+            # changes made from now on are notified: (re)load
+            self.reload()
+            self.listening = True
+            while True:
+                timeout = None
+                if self.ttl:
+                    timeout = self.loaded_at + self.ttl - time.time()
+                    if timeout <= 0:
+                        self.reload()
+                        continue
+                readable, _, _ = select.select([connection], [], [], timeout)
+                if not readable:
+                    continue
+                connection.poll()
+                work_ids = set()
+                while connection.notifies:
+                    payload = connection.notifies.pop(0).payload
+                    work_ids.update(payload.split(','))
+                work_ids = sorted(work_ids)
+                for i in range(0, len(work_ids), UPDATE_BATCH):
+                    self.update(work_ids[i:i + UPDATE_BATCH])
+        finally:
+            self.listening = False
+            connection.close()
+
+
+def notify(work_ids):
+    """Notify the processes keeping a copy of the database of the changes
+    made to the given works, with a single query.
+
+    Must be run in the transaction making the changes: PostgreSQL delivers
+    the notifications when it commits, and drops them if it is rolled back.
+    """
+    work_ids = sorted(set(work_ids))
+    payloads = [','.join(work_ids[i:i + NOTIFY_BATCH])
+                for i in range(0, len(work_ids), NOTIFY_BATCH)]
+    db.query('''SELECT count(pg_notify($channel, payload))
+                FROM unnest($payloads::text[]) payload''',
+             dict(channel=CHANNEL, payloads=SQLArray(payloads)))
@@ -1,13 +1,101 @@
+import os
 import web
+import json
+import events
 from aux import logger_instance, debug_mode
 from uri import URI
-from .operations import do_query
+from cache import LRUCache, SingleFlight
+from . import titleindex, snapshot, snapshotfile, urifilter, changefeed
+from dbtypes import SQLArray
+from .operations import do_query, do_prepared, load_works
 
 logger = logger_instance(__name__)
 web.config.debug = debug_mode()
 
+# cache of get_from_uri() results, a size of 0 disables it
+uri_cache = LRUCache('uri_cache',
+                     maxsize=int(os.getenv('URI_CACHE_SIZE', 10000)),
+                     ttl=int(os.getenv('URI_CACHE_TTL', 300)))
+
+# identical lookups and searches running at once share a single query
+uri_flights = SingleFlight('uri_lookups')
+title_flights = SingleFlight('title_searches')
+
+# seconds lookups matching no work are cached for (0 does not cache them)
+URI_MISS_TTL = int(os.getenv('URI_MISS_TTL', 30))
+
+# Bloom filter of the stored URIs, answering lookups of unknown ones
+if os.getenv('URI_FILTER', 'false').lower() == 'true':
+    uri_filter = urifilter.UriFilter(
+        ttl=int(os.getenv('URI_FILTER_TTL', 900)),
+        error_rate=float(os.getenv('URI_FILTER_ERROR_RATE', 0.01)))
+    urifilter.subscribe(uri_filter)
+else:
+    uri_filter = None
+
+# title matching engine: 'database' or 'memory' (in-process title index)
+if os.getenv('TITLE_MATCH_ENGINE', 'database') == 'memory':
+    title_index = titleindex.TitleIndex(
+        ttl=int(os.getenv('TITLE_INDEX_TTL', 3600)))
+    titleindex.subscribe(title_index)
+else:
+    title_index = None
+
+# URI translation engine: 'database', 'memory' (in-process snapshot) or
+# 'mmap' (snapshot file mapped in memory)
+TRANSLATE_ENGINE = os.getenv('TRANSLATE_ENGINE', 'database')
+if TRANSLATE_ENGINE == 'memory':
+    uri_snapshot = snapshot.Snapshot(ttl=int(os.getenv('SNAPSHOT_TTL', 3600)))
+    snapshot.subscribe(uri_snapshot)
+elif TRANSLATE_ENGINE == 'mmap':
+    uri_snapshot = snapshotfile.MappedSnapshot(
+        os.environ['SNAPSHOT_FILE'],
+        check_after=int(os.getenv('SNAPSHOT_CHECK_AFTER', 60)))
+    snapshotfile.subscribe(uri_snapshot)
+else:
+    uri_snapshot = None
+
 
 class Identifier():
+    # title matching modes
+    TIERED = 'tiered'
+    FUZZY  = 'fuzzy'
+
+    # branches of the title matching query, by kind of match; %(filters)s is
+    # replaced with the filtering clauses, %(max_bytes)d with the length of
+    # the longest titles the Levenshtein distance is computed for
+    TITLE_MATCHES = {
+        titleindex.EXACT: ['''
+            SELECT work_title.work_id, work_type,uri_scheme, uri_value,
+                    canonical, 0 AS score
+            FROM work_title INNER JOIN work USING(work_id)
+            INNER JOIN work_uri USING(work_id)
+            WHERE lower(work_title.title)  = $title %(filters)s'''],
+        titleindex.PREFIX: ['''
+            SELECT work_title.work_id, work_type,uri_scheme, uri_value,
+                    canonical, 1 AS score
+            FROM work_title INNER JOIN work USING(work_id)
+            INNER JOIN work_uri USING(work_id)
+            WHERE substr(lower(work_title.title), 1, length($title))
+                  = $title %(filters)s''', '''
+            SELECT work_title.work_id, work_type,uri_scheme, uri_value,
+                    canonical, 1 AS score
+            FROM work_title INNER JOIN work USING(work_id)
+            INNER JOIN work_uri USING(work_id)
+            WHERE substr($title, 1, length(work_title.title))
+                  = lower(work_title.title) %(filters)s'''],
+        titleindex.FUZZY: ['''
+            SELECT * FROM (
+                SELECT work_title.work_id, work_type, uri_scheme,
+                      uri_value, canonical,
+                      levenshtein(lower(work_title.title), $title)
+                        as score
+                FROM work_title INNER JOIN work USING(work_id)
+                INNER JOIN work_uri USING(work_id)
+                WHERE octet_length(title) <= %(max_bytes)d %(filters)s) q
+            WHERE score <= ((length($title)/3)+1)''']
+    }
+
     def __init__(self, uri, canonical, score, work={}):
         self.URI_parts = uri
         self.canonical = canonical
@@ -16,8 +104,7 @@ class Identifier():
         work_id = work.get('work_id', None)
         work_type = work.get('work_type', None)
         if work_id:
-            from .work import Work
-            self.work = Work(work_id, work_type).__dict__
+            self.work = load_works([(work_id, work_type)])[work_id]
 
     def is_canonical(self):
         return self.canonical
@@ -27,9 +114,13 @@ class Identifier():
                                      self.URI_parts['value'])
 
     @staticmethod
-    def insert_if_not_exist(uri_scheme, uri_value):
-        option = dict(sch=uri_scheme, val=uri_value)
-        q = '''INSERT INTO uri VALUES($sch, $val) ON CONFLICT DO NOTHING'''
+    def insert_all_if_not_exist(uris):
+        """Insert the [scheme, value] pairs given in a single statement"""
+        option = dict(schs=SQLArray([scheme for scheme, _ in uris]),
+                      vals=SQLArray([value for _, value in uris]))
+        q = '''INSERT INTO uri
+               SELECT * FROM unnest($schs::text[], $vals::text[])
+               ON CONFLICT DO NOTHING'''
         return do_query(q, option)
 
     @staticmethod
@@ -62,6 +153,46 @@ class Identifier():
 
     @staticmethod
     def get_from_uri(input_scheme, input_value, clause, params):
+        """Get all URIs of the works identified by the given URI.
+
+        Results are cached, tagged with the input URI and the works matched,
+        while the changes notified by all processes are being received
+        - unless TRANSLATE_ENGINE is set to 'memory' or 'mmap', in which case
+        they are obtained from the snapshot whenever it can answer. Lookups
+        matching no work are cached for URI_MISS_TTL seconds only, and those
+        of URIs that the URI filter (if enabled) knows not to be stored are
+        answered straight away.
+        """
+        if uri_filter and not uri_filter.may_exist(input_scheme, input_value):
+            return []
+        if uri_snapshot:
+            results = uri_snapshot.get_from_uri(input_scheme, input_value,
+                                                params)
+            if results is not None:
+                return results
+        key = (input_scheme.lower(), input_value.lower(), clause,
+               json.dumps(params, sort_keys=True))
+        cached = False
+        if uri_cache_feed:
+            uri_cache_feed.ensure_started()
+            # changes made by other processes are only known while listening
+            cached = uri_cache_feed.listening
+        results = uri_cache.get(key) if cached else None
+        if results is None:
+            version = uri_cache.version
+            # lookups started before an invalidation are not shared
+            results = uri_flights.do(key + (version,), lambda: list(
+                Identifier.query_uri(input_scheme, input_value, clause,
+                                     params)))
+            tags = [('uri', key[0], key[1])]
+            tags += [('work', e["work_id"]) for e in results]
+            ttl = None if results else URI_MISS_TTL
+            if cached and ttl != 0:
+                uri_cache.set(key, results, tags, version, ttl=ttl)
+        return list(results)
+
+    @staticmethod
+    def query_uri(input_scheme, input_value, clause, params):
         options = {"inscheme": input_scheme, "invalue": input_value}
         options.update(params)
         q = '''SELECT work_id, work_type, uri_scheme,
@@ -72,10 +203,95 @@ class Identifier():
                                   AND uri_value = lower($invalue))
                 ''' + clause + '''
                 ORDER BY canonical DESC;'''
-        return do_query(q, options)
+        return do_prepared(q, options, 'lookup')
+
+    @staticmethod
+    def get_from_uris(uris, clause, params):
+        """Run get_from_uri() for a list of [scheme, value] pairs at once.
+
+        Each row includes the input_scheme and input_value it was matched by,
+        results are ordered by input so that they can be grouped back.
+        """
+        if uri_filter:
+            uris = [(scheme, value) for scheme, value in uris
+                    if uri_filter.may_exist(scheme, value)]
+            if not uris:
+                return []
+        if uri_snapshot:
+            results = uri_snapshot.get_from_uris(uris, params)
+            if results is not None:
+                return results
+        options = {"inschemes": SQLArray([scheme for scheme, _ in uris]),
+                   "invalues": SQLArray([value for _, value in uris])}
+        options.update(params)
+        q = '''SELECT input_scheme, input_value, work_id, work_type,
+                        uri_scheme, uri_value, canonical, 0 AS score
+                FROM (SELECT DISTINCT uri_scheme AS input_scheme,
+                             uri_value AS input_value, work_id
+                      FROM work_uri
+                      WHERE (uri_scheme, uri_value) IN (
+                          SELECT * FROM unnest($inschemes::text[],
+                                               $invalues::text[]))) input
+                INNER JOIN work_uri USING(work_id)
+                INNER JOIN work USING(work_id)
+                WHERE 1=1 ''' + clause + '''
+                ORDER BY input_scheme, input_value, canonical DESC;'''
+        return do_prepared(q, options, 'lookup')
+
+    @staticmethod
+    def get_from_title(title, clause, params, scheme='', value='',
+                       match=TIERED, best_only=False):
+        """Get the URIs of the works with a title matching the one given.
+
+        Candidates are scored 0 when the title matches exactly, 1 when one
+        title is a prefix of the other, and with their Levenshtein distance
+        to the input otherwise. In tiered mode each kind of match is only
+        attempted when the previous one produced no results, skipping the
+        Levenshtein scan of the whole table whenever possible; in fuzzy mode
+        all candidates are obtained at once.
+
+        Matches are computed by the database, or by the in-process title
+        index when TITLE_MATCH_ENGINE is set to 'memory'. With best_only
+        only the candidates sharing the lowest score are returned. Identical
+        searches running at once share their results.
+        """
+        key = (title.lower(), clause, json.dumps(params, sort_keys=True),
+               (scheme or '').lower(), (value or '').lower(), match,
+               best_only, uri_cache.version)
+        return title_flights.do(key, lambda: Identifier.match_title(
+            title, clause, params, scheme, value, match, best_only))
 
     @staticmethod
-    def get_from_title(title, clause, params, scheme='', value=''):
+    def match_title(title, clause, params, scheme='', value='',
+                    match=TIERED, best_only=False):
+        if match == Identifier.FUZZY:
+            tiers = [[titleindex.EXACT, titleindex.PREFIX, titleindex.FUZZY]]
+        else:
+            tiers = [[titleindex.EXACT], [titleindex.PREFIX],
+                     [titleindex.FUZZY]]
+
+        results = []
+        for kinds in tiers:
+            results = None
+            if title_index:
+                results = title_index.get_from_title(title, kinds, clause,
+                                                     params, scheme, value,
+                                                     best_only)
+            if results is None:
+                results = Identifier.query_title(title, kinds, clause, params,
+                                                 scheme, value, best_only)
+            if results:
+                break
+        return results
+
+    @staticmethod
+    def query_title(title, kinds, clause, params, scheme='', value='',
+                    best_only=False):
+        """Get title matches of the given kinds from the database.
+
+        With best_only only the candidates sharing the lowest score are
+        fetched, which is all strict mode needs to choose a result.
+        """
         if scheme and value:
             uri_clause = ''' AND work_title.work_id IN
                               (SELECT work_id FROM work_uri WHERE
@@ -84,43 +300,61 @@ class Identifier():
             uri_clause = ''
         options = {"title": title.lower(), "scheme": scheme, "value": value}
         options.update(params)
-        q = '''SELECT * FROM (
-            SELECT DISTINCT ON (work_id, uri_scheme, uri_value) work_id,
+        filters = {"filters": clause + uri_clause,
+                   "max_bytes": titleindex.FUZZY_MAX_BYTES}
+        branches = [(branch % filters) for kind in kinds
+                    for branch in Identifier.TITLE_MATCHES[kind]]
+        q = '''SELECT DISTINCT ON (work_id, uri_scheme, uri_value) work_id,
                     work_type, uri_scheme, uri_value, canonical, score
-            FROM (
-                SELECT work_title.work_id, work_type,uri_scheme, uri_value,
-                        canonical, 0 AS score
-                FROM work_title INNER JOIN work USING(work_id)
-                INNER JOIN work_uri USING(work_id)
-                WHERE lower(work_title.title)  = $title ''' + clause + '''
-                      ''' + uri_clause + '''
-                UNION
-                SELECT work_title.work_id, work_type,uri_scheme, uri_value,
-                        canonical, 1 AS score
-                FROM work_title INNER JOIN work USING(work_id)
-                INNER JOIN work_uri USING(work_id)
-                WHERE substr(lower(work_title.title), 1, length($title))
-                      = $title ''' + clause + uri_clause + '''
-                UNION
-                SELECT work_title.work_id, work_type,uri_scheme, uri_value,
-                        canonical, 1 AS score
-                FROM work_title INNER JOIN work USING(work_id)
-                INNER JOIN work_uri USING(work_id)
-                WHERE substr($title, 1, length(work_title.title))
-                      = lower(work_title.title) ''' + clause + '''
-                      ''' + uri_clause + '''
-                UNION
-                SELECT * FROM (
-                    SELECT work_title.work_id, work_type, uri_scheme,
-                          uri_value, canonical,
-                          levenshtein(lower(work_title.title), $title)
-                            as score
-                    FROM work_title INNER JOIN work USING(work_id)
-                    INNER JOIN work_uri USING(work_id)
-                    WHERE pg_column_size(title) < 255 ''' + clause + '''
-                          ''' + uri_clause + ''') q
-                WHERE score <= ((length($title)/3)+1)
-            ) query
-            ORDER BY work_id,uri_scheme, uri_value, score, canonical
-        ) result ORDER BY score ASC, canonical DESC;'''
-        return do_query(q, options)
+            FROM (''' + " UNION ".join(branches) + ''') query
+            ORDER BY work_id,uri_scheme, uri_value, score, canonical'''
+        if best_only:
+            q = '''SELECT work_id, work_type, uri_scheme, uri_value,
+                          canonical, score
+                   FROM (SELECT *, min(score) OVER () AS best
+                         FROM (''' + q + ''') candidates) result
+                   WHERE score = best'''
+        else:
+            q = '''SELECT * FROM (''' + q + ''') result'''
+        q += ''' ORDER BY score ASC, canonical DESC;'''
+        return do_prepared(q, options, 'search')
+
+
+def invalidate_uri_cache(work_id, uris=[], titles=[]):
+    """Remove cached lookups matching the work or any of the URIs given"""
+    uri_cache.invalidate(('work', work_id),
+                         *[('uri', scheme, value) for scheme, value in uris])
+
+
+def invalidate_uri_cache_many(changes):
+    """Remove cached lookups matching any of the works or URIs changed"""
+    tags = []
+    for work_id, uris, _ in changes:
+        tags.append(('work', work_id))
+        tags += [('uri', scheme, value) for scheme, value in uris]
+    uri_cache.invalidate(*tags)
+
+
+def invalidate_changed_works(work_ids):
+    """Remove cached lookups matching the works changed by any process, or
+    any of their current URIs"""
+    from .work import Work
+    tags = [('work', work_id) for work_id in work_ids]
+    for row in Work.get_by_work_id(work_ids).values():
+        tags += [('uri', e["uri_scheme"], e["uri_value"])
+                 for e in row["uris"]]
+    uri_cache.invalidate(*tags)
+
+
+events.subscribe(events.WORK_SAVED, invalidate_uri_cache,
+                 invalidate_uri_cache_many)
+events.subscribe(events.URIS_DELETED, invalidate_uri_cache)
+events.subscribe(events.WORK_DELETED, invalidate_uri_cache)
+
+# the cache of every process is invalidated with the changes notified by all
+# of them, and cleared whenever notifications may have been missed
+if uri_cache.enabled():
+    uri_cache_feed = changefeed.ChangeFeed('uri_cache', uri_cache.clear,
+                                           invalidate_changed_works, ttl=0)
+else:
+    uri_cache_feed = None
@@ -0,0 +1,112 @@
+import io
+import csv
+import json
+import zlib
+import web
+import psycopg2
+from aux import logger_instance, debug_mode
+from api import db
+from dbpool import set_timeout_sql
+from errors import Error, FATAL
+from .operations import stream_query
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+COLUMNS = ['work_id', 'work_type', 'uri_scheme', 'uri_value', 'canonical']
+
+# separator of multiple titles in CSV exports
+TITLES_SEPARATOR = '|'
+
+
+def mapping_query(since=None, titles=False):
+    """Query of the URI to work mapping, one row per URI.
+
+    `since` restricts the mapping to URIs added since the given timestamp,
+    which relies on PostgreSQL's commit timestamps (track_commit_timestamp).
+    """
+    q = '''SELECT work_id, work_type, uri_scheme, uri_value, canonical'''
+    if titles:
+        q += ''', COALESCE((SELECT array_agg(title ORDER BY title)
+                            FROM work_title
+                            WHERE work_title.work_id = work.work_id),
+                           '{}') AS titles'''
+    q += ''' FROM work INNER JOIN work_uri USING(work_id)'''
+    if since:
+        q += ''' WHERE pg_xact_commit_timestamp(work_uri.xmin)
+                       > $since::timestamptz'''
+    q += ''' ORDER BY work_id, uri_scheme, uri_value'''
+    return q
+
+
+def get_mapping(since=None, titles=False):
+    """Stream the URI to work mapping from a server-side cursor"""
+    return stream_query(mapping_query(since, titles), dict(since=since),
+                        itersize=5000)
+
+
+def iter_ndjson(rows, batch_size=1000):
+    """Convert rows to newline delimited JSON, `batch_size` rows a chunk"""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(row, ensure_ascii=False))
+        if len(lines) >= batch_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def iter_csv(rows, titles=False, batch_size=1000):
+    """Convert rows to CSV, with a header, `batch_size` rows a chunk"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(COLUMNS + (['titles'] if titles else []))
+    for i, row in enumerate(rows, 1):
+        values = [row[column] for column in COLUMNS]
+        values[-1] = 'true' if row['canonical'] else 'false'
+        if titles:
+            values.append(TITLES_SEPARATOR.join(row['titles']))
+        writer.writerow(values)
+        if i % batch_size == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue()
+
+
+def iter_gzip(chunks):
+    """Compress text chunks on the fly, in gzip format"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def copy_csv(output, since=None, titles=False):
+    """Write the mapping as CSV to a (text) file with COPY TO"""
+    q = '''SELECT work_id, work_type, uri_scheme, uri_value,
+                  canonical::text'''
+    if titles:
+        q += ''', array_to_string(titles, '%s') AS titles''' % (
+            TITLES_SEPARATOR)
+    q += ''' FROM (''' + mapping_query(since, titles) + ''') mapping'''
+    sql_query = web.db.reparam(q, dict(since=since))
+    try:
+        connection, info = db.getconn()
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(error)
+        raise Error(FATAL)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(set_timeout_sql('export'))
+        query = cursor.mogrify(sql_query.query(), sql_query.values())
+        cursor.copy_expert('COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER)'
+                           % (query.decode('utf-8')), output)
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(error)
+        raise Error(FATAL)
+    finally:
+        db.pool.putconn(connection, info)
@@ -1,14 +1,23 @@
+import re
 import web
+import hashlib
 import psycopg2
-from aux import logger_instance, debug_mode
+from psycopg2.extras import RealDictCursor
+from aux import logger_instance, debug_mode, generate_uuid
 from api import db
+from dbpool import set_timeout_sql
 from errors import Error, FATAL
 
 logger = logger_instance(__name__)
 web.config.debug = debug_mode()
 
+# web.py-style query parameter, e.g. $work_id
+PARAMETER = re.compile(r'\$([A-Za-z_][A-Za-z0-9_]*)')
+
 
 def results_to_identifiers(results):
+    results = list(results)
+    preload_works(results)
     return [(result_to_identifier(e).__dict__) for e in results]
 
 
@@ -24,7 +33,41 @@ def result_to_identifier(result):
 def result_to_work(result):
     from .work import Work
     return Work(result.get('work_id'), result.get('work_type'),
-                result.get('titles', []))
+                result.get('titles'))
+
+
+def work_identity_map():
+    """Return the works loaded during the current request, by work_id.
+
+    web.ctx is cleared at the beginning of each request, so is the map.
+    """
+    if 'work_identity_map' not in web.ctx:
+        web.ctx.work_identity_map = {}
+    return web.ctx.work_identity_map
+
+
+def load_works(works):
+    """Get the given works, as a dictionary of work_id -> Work.__dict__.
+
+    `works` is a list of (work_id, work_type) pairs. Works that have not been
+    loaded yet during this request get their titles in a single query.
+    """
+    from .work import Work
+    loaded = work_identity_map()
+    missing = dict((work_id, work_type) for work_id, work_type in works
+                   if work_id and work_id not in loaded)
+    if missing:
+        titles = Work.get_titles_by_work_id(list(missing.keys()))
+        for work_id, work_type in missing.items():
+            work = Work(work_id, work_type, titles.get(work_id, []))
+            loaded[work_id] = work.__dict__
+    return loaded
+
+
+def preload_works(results):
+    """Load the works of all results at once, ahead of converting them."""
+    return load_works([(e.get('work_id'), e.get('work_type'))
+                       for e in results])
 
 
 def results_to_titles(results):
@@ -46,59 +89,128 @@ def result_to_work_type(result):
 
 
 def results_to_works(results, include_relatives=False):
-    """Iterate the results to get distinct works with associated identifiers.
+    return list(iter_works(results, include_relatives))
+
+
+def iter_works(results, include_relatives=False, batch_size=500):
+    """Convert the results of Work.get_all() to works.
+
+    Each result is a work with its titles and URIs already aggregated, works
+    are yielded as they are read. Relatives are loaded in batches of
+    `batch_size` works, with a single query per batch.
+    """
+    batch = []
+    for e in results:
+        work = result_to_work(e)
+        work.URI = results_to_identifiers(e["uris"])
+        if not include_relatives:
+            yield work.__dict__
+            continue
+        batch.append(work)
+        if len(batch) >= batch_size:
+            for work in load_relatives(batch):
+                yield work.__dict__
+            batch = []
+    for work in load_relatives(batch):
+        yield work.__dict__
+
+
+def load_relatives(works):
+    """Set the children and parents of the given works in a single query"""
+    from .work import Work
+    relatives = Work.get_relatives_by_work_id([w.UUID for w in works])
+    for work in works:
+        work.set_children(relatives[work.UUID]['child'])
+        work.set_parents(relatives[work.UUID]['parent'])
+    return works
+
+
+def stream_query(query, params, itersize=1000):
+    """Run a query with a server-side cursor, yielding rows as dictionaries.
+
+    Rows are fetched from the database in batches of `itersize`, so memory
+    usage does not depend on the size of the result. The request's
+    connection is taken for the whole iteration (see
+    PooledPostgresDB.getconn()) so that other queries, which use another
+    one, do not close the cursor with their commits while it is being read.
+    """
+    sql_query = web.db.reparam(query, params)
+    try:
+        connection, info = db.getconn()
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(error)
+        raise Error(FATAL)
+    try:
+        connection.cursor().execute(set_timeout_sql('export'))
+        name = 'stream_' + generate_uuid().replace('-', '')
+        cursor = connection.cursor(name, cursor_factory=RealDictCursor)
+        cursor.itersize = itersize
+        cursor.execute(sql_query.query(), sql_query.values())
+        for row in cursor:
+            yield row
+        cursor.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(error)
+        raise Error(FATAL)
+    finally:
+        db.pool.putconn(connection, info)
+
 
-    Without this method we would need to query the list of work_ids, then
-    their titles and uris - iterating the full data set, filtering as needed,
-    is a lot faster.
+def do_prepared(query, params, query_class=None):
+    """Run a query as a server-side prepared statement, returning its rows.
+
+    web.py-style `$name` parameters are replaced with positional ones and the
+    statement, named after a digest of its text, is prepared once per
+    database connection and run with EXECUTE thereafter - saving PostgreSQL
+    from parsing and planning it on every call. `query_class` selects the
+    statement_timeout to run it with (see dbpool.STATEMENT_TIMEOUTS).
     """
-    data     = []  # output
-    titles   = []  # temporary array of work titles
-    uris     = []  # temp array of work URIs (strings, used for comparison)
-    uris_fmt = []  # temporary array of work URIs (Identifier objects)
-
-    for i, e in enumerate(results):
-        if i == 0:
-            # we can't do cur=results[0] outsise--it moves IterBetter's pointer
-            cur = e
-        if e["work_id"] != cur["work_id"]:
-            cur["titles"] = titles
-            cur["URI"] = uris_fmt
-            work = result_to_work(cur)
-            work.URI = results_to_identifiers(cur["URI"])
-            if include_relatives:
-                work.load_children()
-                work.load_parents()
-            data.append(work.__dict__)
-            titles = []
-            uris = []
-            uris_fmt = []
-            cur = e
-
-        if e["title"] not in titles:
-            titles.append(e["title"])
-        if [e["uri_scheme"], e["uri_value"], e["canonical"]] not in uris:
-            uris.append([e["uri_scheme"], e["uri_value"], e["canonical"]])
-            uris_fmt.append({"uri_scheme": e["uri_scheme"],
-                             "uri_value": e["uri_value"],
-                             "canonical": e["canonical"]})
+    names = []
+
+    def positional(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return '$%d' % (names.index(match.group(1)) + 1)
+
+    statement = PARAMETER.sub(positional, query).strip().rstrip(';')
+    name = 'stmt_' + hashlib.md5(statement.encode('utf-8')).hexdigest()
+    try:
+        ctx = db.ctx
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(error)
+        raise Error(FATAL)
+    connection = ctx.db
     try:
-        cur["titles"] = titles
-        cur["URI"] = uris_fmt
-        work = result_to_work(cur)
-        work.URI = results_to_identifiers(cur["URI"])
-        if include_relatives:
-            work.load_children()
-            work.load_parents()
-        data.append(work.__dict__)
-    except NameError:
-        # we need to run the above with the last element of IterBetter, if it
-        # fails it means that no results were iterated
-        pass
-    return data
-
-
-def do_query(query, params):
+        cursor = connection.cursor(cursor_factory=RealDictCursor)
+        if name not in connection.prepared:
+            cursor.execute('PREPARE %s AS %s' % (name, statement))
+            connection.prepared.add(name)
+        markers = ', '.join(['%s'] * len(names))
+        execute = ('EXECUTE %s (%s)' % (name, markers) if names
+                   else 'EXECUTE %s' % (name))
+        if query_class:
+            execute = set_timeout_sql(query_class) + execute
+        cursor.execute(execute, [params[key] for key in names])
+        rows = [web.storage(row) for row in cursor.fetchall()]
+        if not ctx.transactions:
+            ctx.commit()
+        return rows
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(error)
+        # we cannot know which statements survived the failure, so the
+        # connection is not reused
+        connection.discard()
+        if ctx.transactions:
+            ctx.transactions[-1].rollback()
+        else:
+            ctx.rollback()
+        raise Error(FATAL)
+
+
+def do_query(query, params, query_class=None):
+    """Run a query, with the statement_timeout of `query_class` if given"""
+    if query_class:
+        query = set_timeout_sql(query_class) + query
     try:
         return db.query(query, params)
     except (Exception, psycopg2.DatabaseError) as error:
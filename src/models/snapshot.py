@@ -0,0 +1,242 @@
+import sys
+import time
+import threading
+import web
+import events
+import metrics
+from aux import logger_instance, debug_mode
+from api import db
+from dbpool import set_timeout_sql
+from .operations import work_identity_map
+from . import changefeed
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+# attributes filters may be applied to, see api.build_parms()
+FILTERS = ('work_type', 'uri_scheme', 'canonical')
+
+
+def uri_key(scheme, value):
+    return scheme.lower() + '\x00' + value.lower()
+
+
+class SnapshotLookups():
+    """URI lookups answered from a copy of the works.
+
+    Subclasses implement lookup(), getting the (work_id, work_type, titles,
+    uris) tuples of the works identified by each URI, and have a `name`
+    (the prefix of their metrics), a `lock` and a `stale` dictionary of
+    the works changed since the copy was made, which it may not reflect.
+    """
+
+    def changed(self, work_id, uris=[], titles=[]):
+        """Mark a work, and the URIs given, as stale"""
+        now = time.time()
+        with self.lock:
+            self.stale[work_id] = (work_id, now)
+            for scheme, value in uris:
+                self.stale[uri_key(scheme, value)] = (work_id, now)
+
+    def forget_stale(self, before=None, work_ids=()):
+        """Unmark the works changed before the given time, or those given"""
+        with self.lock:
+            for key, (work_id, marked_at) in list(self.stale.items()):
+                if work_id in work_ids or (before and marked_at < before):
+                    del self.stale[key]
+
+    def is_stale(self, keys, matches):
+        if not self.stale:
+            return False
+        if any(key in self.stale for key in keys):
+            return True
+        return any(work_id in self.stale for works in matches
+                   for work_id, _, _, _ in works)
+
+    def get_from_uri(self, scheme, value, params):
+        """Equivalent to Identifier.query_uri() using the snapshot.
+
+        Returns None when the snapshot cannot answer.
+        """
+        matches = self.lookup([(scheme, value)])
+        if matches is None:
+            metrics.increment(self.name + '.fallbacks')
+            return None
+        metrics.increment(self.name + '.hits')
+        return self.to_results(matches[0], params)
+
+    def get_from_uris(self, uris, params):
+        """Equivalent to Identifier.get_from_uris() using the snapshot.
+
+        Returns None when the snapshot cannot answer for any of the URIs.
+        """
+        matches = self.lookup(uris)
+        if matches is None:
+            metrics.increment(self.name + '.fallbacks')
+            return None
+        metrics.increment(self.name + '.hits')
+        results = []
+        for (scheme, value), works in zip(uris, matches):
+            for e in self.to_results(works, params):
+                e["input_scheme"], e["input_value"] = scheme, value
+                results.append(e)
+        return results
+
+    def to_results(self, works, params):
+        results = []
+        for work_id, work_type, titles, uris in works:
+            for scheme, value, canonical in uris:
+                e = web.storage(work_id=work_id, work_type=work_type,
+                                uri_scheme=scheme, uri_value=value,
+                                canonical=canonical, score=0)
+                if all(e[f] in params[f] for f in FILTERS if f in params):
+                    results.append(e)
+        self.preload_works(works)
+        return sorted(results, key=lambda e: not e["canonical"])
+
+    def preload_works(self, works):
+        """Add the works to the request's identity map, saving load_works()
+        from querying their titles"""
+        from .work import Work
+        loaded = work_identity_map()
+        for work_id, work_type, titles, _ in works:
+            if work_id not in loaded:
+                loaded[work_id] = Work(work_id, work_type,
+                                       list(titles)).__dict__
+
+
+class Snapshot(SnapshotLookups):
+    """In-process copy of the works, their URIs and their titles.
+
+    Works are numbered, each one stored as a (work_id, work_type, titles,
+    uris) tuple, and a hash index maps every URI to the numbers of the
+    works it identifies; URI schemes and work types are interned. Lookups
+    reproduce Identifier.query_uri() without querying the database.
+
+    The snapshot is loaded by a ChangeFeed, which reloads the works changed
+    through the API as they are notified; it is fully reloaded every `ttl`
+    seconds, and whenever the feed is reconnected, to pick up changes made
+    elsewhere. Until
+    it is loaded - and for the works changed by this process until their
+    notification is received - lookups return None, and callers fall back
+    to the database.
+    """
+
+    def __init__(self, ttl=3600):
+        self.loaded_at = None
+        self.feed      = changefeed.ChangeFeed('snapshot', self.load,
+                                               self.update, ttl)
+        self.lock      = threading.RLock()
+        self.stale     = {}  # work_id or URI key -> (work_id, time changed)
+        self.numbers   = {}  # work_id -> work number
+        self.works     = []  # work number -> (work_id, type, titles, uris)
+        self.index     = {}  # URI key -> tuple of work numbers
+        self.name      = 'snapshot'
+        metrics.register_gauge('snapshot.works', lambda: len(self.numbers))
+        metrics.register_gauge('snapshot.uris', lambda: len(self.index))
+        for counter in ('hits', 'fallbacks', 'reloads', 'updates'):
+            metrics.register_counter('snapshot.' + counter)
+
+    def load(self):
+        started = time.time()
+        numbers, works, index = {}, [], {}
+        connection, info = db.getconn()
+        try:
+            cursor = connection.cursor()
+            # all tables are read from the same snapshot of the database
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ '
+                           'READ ONLY; ' + set_timeout_sql('export'))
+            for work_id, work_type in self.read(
+                    connection, "SELECT work_id, work_type FROM work"):
+                numbers[work_id] = len(works)
+                works.append((work_id, sys.intern(work_type), [], []))
+            for work_id, title in self.read(
+                    connection, "SELECT work_id, title FROM work_title"):
+                if work_id in numbers:
+                    works[numbers[work_id]][2].append(title)
+            for work_id, scheme, value, canonical in self.read(
+                    connection, '''SELECT work_id, uri_scheme, uri_value,
+                                          canonical FROM work_uri'''):
+                if work_id in numbers:
+                    number = numbers[work_id]
+                    works[number][3].append((sys.intern(scheme), value,
+                                             canonical))
+                    key = uri_key(scheme, value)
+                    index[key] = index.get(key, ()) + (number,)
+        finally:
+            db.pool.putconn(connection, info)
+        works = [(work_id, work_type, tuple(titles), tuple(uris))
+                 for work_id, work_type, titles, uris in works]
+        with self.lock:
+            self.numbers, self.works, self.index = numbers, works, index
+            self.loaded_at = started
+        self.forget_stale(before=started)
+        metrics.increment('snapshot.reloads')
+
+    def read(self, connection, query):
+        cursor = connection.cursor('snapshot')
+        cursor.itersize = 10000
+        cursor.execute(query)
+        for row in cursor:
+            yield row
+        cursor.close()
+
+    def update(self, work_ids):
+        """Reload the given works from the database"""
+        from .work import Work, normalise_uuids
+        work_ids = set(normalise_uuids(work_ids))
+        found = Work.get_by_work_id(list(work_ids))
+        with self.lock:
+            for work_id in work_ids:
+                self.unindex(work_id)
+                if work_id in found:
+                    self.index_work(found[work_id])
+        self.forget_stale(work_ids=work_ids)
+        metrics.increment('snapshot.updates')
+
+    def unindex(self, work_id):
+        number = self.numbers.pop(work_id, None)
+        if number is None:
+            return
+        for scheme, value, _ in self.works[number][3]:
+            key = uri_key(scheme, value)
+            remaining = tuple(n for n in self.index.get(key, ())
+                              if n != number)
+            if remaining:
+                self.index[key] = remaining
+            else:
+                self.index.pop(key, None)
+        self.works[number] = None
+
+    def index_work(self, row):
+        number = len(self.works)
+        uris = tuple((sys.intern(e['uri_scheme']), e['uri_value'],
+                      e['canonical']) for e in row['uris'])
+        self.works.append((row['work_id'], sys.intern(row['work_type']),
+                           tuple(row['titles']), uris))
+        self.numbers[row['work_id']] = number
+        for scheme, value, _ in uris:
+            key = uri_key(scheme, value)
+            self.index[key] = self.index.get(key, ()) + (number,)
+
+    def lookup(self, uris):
+        """Get the works identified by each of the [scheme, value] pairs
+        given, or None if any of them is not (or not yet) known reliably"""
+        self.feed.ensure_started()
+        if self.loaded_at is None:
+            return None
+        keys = [uri_key(scheme, value) for scheme, value in uris]
+        with self.lock:
+            matches = [[self.works[n] for n in self.index.get(key, ())]
+                       for key in keys]
+            if self.is_stale(keys, matches):
+                return None
+        return matches
+
+
+def subscribe(snapshot):
+    """Apply the changes made by this process to its snapshot straight
+    away"""
+    for event in (events.WORK_SAVED, events.URIS_DELETED,
+                  events.TITLES_DELETED, events.WORK_DELETED):
+        events.subscribe(event, snapshot.changed)
@@ -0,0 +1,243 @@
+import os
+import mmap
+import time
+import uuid
+import struct
+import threading
+import web
+import events
+import metrics
+from aux import logger_instance, debug_mode
+from .snapshot import Snapshot, SnapshotLookups, uri_key
+from . import changefeed
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+MAGIC   = b'ITSSNAP1'
+VERSION = 1
+
+# Records of the file, little-endian. Strings are (offset, length) pairs
+# referencing the UTF-8 bytes of the string table, at the end of the file.
+#  - header: magic, version, time compiled, number of works, titles, URIs
+#    and keys;
+#  - work: UUID, type, first title, number of titles, first URI, number of
+#    URIs;
+#  - title: title;
+#  - URI: scheme, value, canonical;
+#  - key: URI, work number - sorted by URI key.
+HEADER = struct.Struct('<8sIdIIII')
+WORK   = struct.Struct('<16sQIIIII')
+TITLE  = struct.Struct('<QI')
+URI    = struct.Struct('<QIQIB')
+KEY    = struct.Struct('<II')
+
+
+def write(path, snapshot):
+    """Write a loaded Snapshot to a file, replacing it atomically.
+
+    The file holds, after the header, fixed size records of works (each one
+    pointing to a range of titles and of URIs), titles, URIs and keys, then
+    the string table. Keys are sorted by the UTF-8 bytes of the URI key
+    ('scheme\\0value'), so that lookups are a binary search over them.
+    """
+    strings = bytearray()
+    offsets = {}  # shared strings (work types and schemes) -> offset
+
+    def string(text, shared=False):
+        data = text.encode('utf-8')
+        if shared and text in offsets:
+            return offsets[text], len(data)
+        offset = len(strings)
+        strings.extend(data)
+        if shared:
+            offsets[text] = offset
+        return offset, len(data)
+
+    works, titles, uris, keys = [], [], [], []
+    for work in snapshot.works:
+        if work is None:
+            continue
+        work_id, work_type, work_titles, work_uris = work
+        type_offset, type_length = string(work_type, shared=True)
+        works.append(WORK.pack(uuid.UUID(work_id).bytes, type_offset,
+                               type_length, len(titles), len(work_titles),
+                               len(uris), len(work_uris)))
+        for title in work_titles:
+            titles.append(TITLE.pack(*string(title)))
+        for scheme, value, canonical in work_uris:
+            # stored values are compared as they are, as in the database
+            key = (scheme + '\x00' + value).encode('utf-8')
+            keys.append((key, len(uris), len(works) - 1))
+            scheme_offset, scheme_length = string(scheme, shared=True)
+            value_offset, value_length = string(value)
+            uris.append(URI.pack(scheme_offset, scheme_length, value_offset,
+                                 value_length, canonical))
+    keys.sort()
+
+    with open(path + '.tmp', 'wb') as output:
+        output.write(HEADER.pack(MAGIC, VERSION, snapshot.loaded_at,
+                                 len(works), len(titles), len(uris),
+                                 len(keys)))
+        for records in (works, titles, uris):
+            output.write(b''.join(records))
+        output.write(b''.join(KEY.pack(uri, number)
+                              for _, uri, number in keys))
+        output.write(strings)
+    os.replace(path + '.tmp', path)
+
+
+def compile_snapshot(path):
+    """Load the works from the database and write them to a file"""
+    snapshot = Snapshot(ttl=0)
+    snapshot.load()
+    write(path, snapshot)
+    return snapshot
+
+
+class MappedSnapshot(SnapshotLookups):
+    """URI lookups served from a snapshot file, mapped in memory.
+
+    Lookups are a binary search over the sorted keys of the file, decoding
+    only the works found, so the file is shared by all processes through
+    the OS page cache and needs no loading. Every `check_after` seconds the
+    file is checked for a new version, which is mapped in its place.
+
+    The file only reflects the database as it was when compiled: the works
+    changed since then, by this process or by any other as notified to its
+    ChangeFeed, are looked up in the database. Changes made while the feed
+    is not listening (e.g. before the process started) are only reflected
+    by the next version of the file.
+    """
+
+    def __init__(self, path, check_after=60):
+        self.path        = path
+        self.check_after = check_after
+        self.checked_at  = 0
+        self.mapped      = None  # (file identity, mmap, offsets, counts)
+        self.lock        = threading.RLock()
+        self.stale       = {}  # work_id or URI key -> (work_id, time changed)
+        self.name        = 'snapshot_file'
+        self.feed        = changefeed.ChangeFeed('snapshot_file',
+                                                 self.ensure_current,
+                                                 self.update, ttl=0)
+        for counter in ('hits', 'fallbacks', 'reloads'):
+            metrics.register_counter('snapshot_file.' + counter)
+
+    def ensure_current(self):
+        now = time.time()
+        if self.checked_at + self.check_after > now:
+            return
+        with self.lock:
+            self.checked_at = now
+            try:
+                stat = os.stat(self.path)
+                identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+                if self.mapped is None or self.mapped[0] != identity:
+                    self.open(identity)
+            except Exception as error:
+                logger.error(error)
+
+    def open(self, identity):
+        with open(self.path, 'rb') as snapshot_file:
+            data = mmap.mmap(snapshot_file.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+        magic, version, created, n_works, n_titles, n_uris, n_keys = \
+            HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a snapshot file" % (self.path))
+        offsets = [HEADER.size]
+        for size, count in ((WORK.size, n_works), (TITLE.size, n_titles),
+                            (URI.size, n_uris), (KEY.size, n_keys)):
+            offsets.append(offsets[-1] + size * count)
+        # the previous map is closed once no lookup references it
+        self.mapped = (identity, data, offsets, n_keys)
+        self.forget_stale(before=created)
+        metrics.increment('snapshot_file.reloads')
+
+    def update(self, work_ids):
+        """Mark the given works, and their current URIs, as changed"""
+        from .work import Work
+        found = Work.get_by_work_id(work_ids)
+        for work_id in work_ids:
+            uris = [(e["uri_scheme"], e["uri_value"])
+                    for e in found.get(work_id, {}).get("uris", [])]
+            self.changed(work_id, uris=uris)
+
+    def lookup(self, uris):
+        """Get the works identified by each of the [scheme, value] pairs
+        given, or None if the file is not available or any of them may have
+        changed since it was compiled"""
+        self.feed.ensure_started()
+        self.ensure_current()
+        mapped = self.mapped
+        if mapped is None:
+            return None
+        keys = [uri_key(scheme, value) for scheme, value in uris]
+        matches = [[self.work(mapped, n) for n in self.find(mapped, key)]
+                   for key in keys]
+        with self.lock:
+            if self.is_stale(keys, matches):
+                return None
+        return matches
+
+    def find(self, mapped, key):
+        """Binary search of the numbers of the works with the URI key"""
+        _, data, offsets, n_keys = mapped
+        key = key.encode('utf-8')
+        low, high = 0, n_keys
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(mapped, middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        numbers = []
+        while low < n_keys:
+            found, number = self.key(mapped, low)
+            if found != key:
+                break
+            numbers.append(number)
+            low += 1
+        return numbers
+
+    def key(self, mapped, position):
+        _, data, offsets, _ = mapped
+        uri, number = KEY.unpack_from(data, offsets[3] + position * KEY.size)
+        scheme, scheme_length, value, value_length, _ = URI.unpack_from(
+            data, offsets[2] + uri * URI.size)
+        strings = offsets[4]
+        key = b'\x00'.join([
+            data[strings + scheme:strings + scheme + scheme_length],
+            data[strings + value:strings + value + value_length]])
+        return key, number
+
+    def work(self, mapped, number):
+        _, data, offsets, _ = mapped
+
+        def string(offset, length):
+            start = offsets[4] + offset
+            return data[start:start + length].decode('utf-8')
+
+        work_id, work_type, type_length, first_title, n_titles, first_uri, \
+            n_uris = WORK.unpack_from(data, offsets[0] + number * WORK.size)
+        titles = []
+        for i in range(first_title, first_title + n_titles):
+            titles.append(string(*TITLE.unpack_from(
+                data, offsets[1] + i * TITLE.size)))
+        uris = []
+        for i in range(first_uri, first_uri + n_uris):
+            scheme, scheme_length, value, value_length, canonical = \
+                URI.unpack_from(data, offsets[2] + i * URI.size)
+            uris.append((string(scheme, scheme_length),
+                         string(value, value_length), bool(canonical)))
+        return (str(uuid.UUID(bytes=work_id)), string(work_type, type_length),
+                tuple(titles), tuple(uris))
+
+
+def subscribe(snapshot):
+    """Look the works changed by this process up in the database straight
+    away"""
+    for event in (events.WORK_SAVED, events.URIS_DELETED,
+                  events.TITLES_DELETED, events.WORK_DELETED):
+        events.subscribe(event, snapshot.changed)
@@ -2,6 +2,7 @@ import web
 import psycopg2
 from aux import logger_instance, debug_mode
 from api import db
+from dbtypes import SQLArray
 from errors import Error, FATAL
 
 logger = logger_instance(__name__)
@@ -12,10 +13,13 @@ class Title():
     def __init__(self, title):
         self.title = title
 
-    def save_if_not_exists(self):
+    @staticmethod
+    def save_all_if_not_exist(titles):
+        """Insert the titles given that are not stored yet, in one statement"""
         try:
-            option = dict(title=self.title)
-            q = '''INSERT INTO title VALUES ($title) ON CONFLICT DO NOTHING'''
+            option = dict(titles=SQLArray(titles))
+            q = '''INSERT INTO title SELECT unnest($titles::text[])
+                   ON CONFLICT DO NOTHING'''
             return db.query(q, option)
         except (Exception, psycopg2.DatabaseError) as error:
             logger.error(error)
@@ -0,0 +1,259 @@
+import time
+import bisect
+import threading
+import web
+import events
+import metrics
+from aux import logger_instance, debug_mode
+from dbtypes import SQLArray
+from .operations import do_query, do_prepared
+from . import changefeed
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+EXACT  = 'exact'
+PREFIX = 'prefix'
+FUZZY  = 'fuzzy'
+
+# length in UTF-8 bytes of the longest titles the Levenshtein distance is
+# computed for, both here and in the database, whose levenshtein() does not
+# accept arguments of 255 bytes or more
+FUZZY_MAX_BYTES = 250
+
+
+def bigrams(text):
+    """Get the set of (padded) bigrams of a string"""
+    padded = '\x00' + text + '\x00'
+    return frozenset(padded[i:i + 2] for i in range(len(padded) - 1))
+
+
+def bounded_levenshtein(a, b, limit):
+    """Levenshtein distance between a and b, or None if greater than limit"""
+    if abs(len(a) - len(b)) > limit:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= limit else None
+
+
+class TitleIndex():
+    """In-process index of lower-cased work titles.
+
+    Reproduces the scores of the title matching query: 0 for exact matches,
+    1 when one title is a prefix of the other, and the Levenshtein distance
+    when it is within (length/3)+1. Fuzzy candidates are pruned with a
+    bigram inverted index (every edit operation removes at most two bigrams
+    of the input) before computing a bounded Levenshtein distance.
+
+    The index is loaded by a ChangeFeed, in the background from first use,
+    which reloads the titles of the works changed through the API as they
+    are notified; it is fully reloaded every `ttl` seconds, and whenever the
+    feed is reconnected, to pick up changes made elsewhere. Changes made by
+    this process are applied straight away. Until it is loaded, searches
+    return None and callers fall back to the database.
+    """
+
+    def __init__(self, ttl=3600):
+        self.loaded_at = None
+        self.feed      = changefeed.ChangeFeed('title_index', self.load,
+                                               self.update, ttl)
+        self.lock      = threading.RLock()
+        self.reset()
+        metrics.register_gauge('title_index.size', lambda: len(self.titles))
+        metrics.register_counter('title_index.reloads')
+        metrics.register_counter('title_index.updates')
+
+    def reset(self):
+        self.works    = {}  # work_id -> set of titles
+        self.titles   = {}  # lower-cased title -> set of work_ids
+        self.sorted   = []  # sorted list of lower-cased titles
+        self.postings = {}  # bigram -> set of lower-cased titles
+        self.lengths  = {}  # title length -> set of lower-cased titles
+
+    def load(self):
+        results = do_query("SELECT work_id, title FROM work_title", {})
+        with self.lock:
+            self.reset()
+            for e in results:
+                self.works.setdefault(e["work_id"], set()).add(e["title"])
+            for work_id, titles in self.works.items():
+                for title in titles:
+                    self.index(title.lower(), work_id)
+            self.loaded_at = time.time()
+        metrics.increment('title_index.reloads')
+
+    def update(self, work_ids):
+        """Reload the titles of the given works from the database"""
+        from .work import Work, normalise_uuids
+        work_ids = normalise_uuids(work_ids)
+        found = Work.get_titles_by_work_id(work_ids)
+        with self.lock:
+            for work_id in work_ids:
+                self.remove(work_id)
+                if work_id in found:
+                    self.add(work_id, titles=found[work_id])
+        metrics.increment('title_index.updates')
+
+    def index(self, title, work_id):
+        if title not in self.titles:
+            self.titles[title] = set()
+            bisect.insort(self.sorted, title)
+            self.lengths.setdefault(len(title), set()).add(title)
+            for gram in bigrams(title):
+                self.postings.setdefault(gram, set()).add(title)
+        self.titles[title].add(work_id)
+
+    def unindex(self, title, work_id):
+        work_ids = self.titles.get(title, set())
+        work_ids.discard(work_id)
+        if work_ids:
+            return
+        self.titles.pop(title, None)
+        position = bisect.bisect_left(self.sorted, title)
+        if position < len(self.sorted) and self.sorted[position] == title:
+            del self.sorted[position]
+        self.lengths.get(len(title), set()).discard(title)
+        for gram in bigrams(title):
+            self.postings.get(gram, set()).discard(title)
+
+    def add(self, work_id, uris=[], titles=[]):
+        with self.lock:
+            if not self.loaded_at:
+                return
+            self.works.setdefault(work_id, set()).update(titles)
+            for title in titles:
+                self.index(title.lower(), work_id)
+
+    def remove(self, work_id, uris=[], titles=[]):
+        with self.lock:
+            if not self.loaded_at:
+                return
+            current = self.works.get(work_id, set())
+            removed = set(titles) if titles else set(current)
+            current.difference_update(removed)
+            if not current:
+                self.works.pop(work_id, None)
+            remaining = set(title.lower() for title in current)
+            for title in set(title.lower() for title in removed):
+                if title not in remaining:
+                    self.unindex(title, work_id)
+
+    def match(self, title, kinds):
+        """Get the best score of each work matching the title given.
+
+        `kinds` is a list of the kinds of match to look for (EXACT, PREFIX
+        and/or FUZZY), returns a dictionary of work_id -> score.
+        """
+        title = title.lower()
+        scores = {}
+        with self.lock:
+            candidates = {}  # lower-cased title -> score
+            if EXACT in kinds and title in self.titles:
+                candidates[title] = 0
+            if PREFIX in kinds:
+                for candidate in self.prefix_matches(title):
+                    candidates.setdefault(candidate, 1)
+            if FUZZY in kinds:
+                for candidate, score in self.fuzzy_matches(title):
+                    if score < candidates.get(candidate, score + 1):
+                        candidates[candidate] = score
+            for candidate, score in candidates.items():
+                for work_id in self.titles[candidate]:
+                    if score < scores.get(work_id, score + 1):
+                        scores[work_id] = score
+        return scores
+
+    def prefix_matches(self, title):
+        """Titles starting with the input, or that the input starts with"""
+        for i in range(1, len(title) + 1):
+            if title[:i] in self.titles:
+                yield title[:i]
+        position = bisect.bisect_left(self.sorted, title)
+        while position < len(self.sorted):
+            candidate = self.sorted[position]
+            if not candidate.startswith(title):
+                break
+            yield candidate
+            position += 1
+
+    def fuzzy_matches(self, title):
+        limit = (len(title) // 3) + 1
+        grams = bigrams(title)
+        required = len(grams) - 2 * limit
+        if required > 0:
+            # any title within the limit shares at least one of these
+            rarest = sorted(grams, key=lambda g: len(self.postings.get(g, ())))
+            candidates = set()
+            for gram in rarest[:len(grams) - required + 1]:
+                candidates.update(self.postings.get(gram, ()))
+        else:
+            candidates = set()
+            for length in range(len(title) - limit, len(title) + limit + 1):
+                candidates.update(self.lengths.get(length, ()))
+        for candidate in candidates:
+            if len(candidate.encode('utf-8')) > FUZZY_MAX_BYTES:
+                continue
+            if required > 0 and len(grams & bigrams(candidate)) < required:
+                continue
+            score = bounded_levenshtein(candidate, title, limit)
+            if score is not None:
+                yield candidate, score
+
+    def get_from_title(self, title, kinds, clause, params, scheme='',
+                       value='', best_only=False):
+        """Equivalent to Identifier.query_title() using the index.
+
+        Only the URIs of the matching works are obtained from the database.
+        With best_only the works are queried by ascending score, stopping at
+        the first score that produces results once filters are applied.
+        Returns None until the index is loaded.
+        """
+        self.feed.ensure_started()
+        if not self.loaded_at:
+            return None
+        scores = self.match(title, kinds)
+        if not scores:
+            return []
+        if not best_only:
+            return self.get_uris(scores, clause, params, scheme, value)
+        for score in sorted(set(scores.values())):
+            group = dict((work_id, work_score)
+                         for work_id, work_score in scores.items()
+                         if work_score == score)
+            results = self.get_uris(group, clause, params, scheme, value)
+            if results:
+                return results
+        return []
+
+    def get_uris(self, scores, clause, params, scheme, value):
+        if scheme and value:
+            uri_clause = ''' AND work_id IN
+                              (SELECT work_id FROM work_uri WHERE
+                               uri_scheme = $scheme AND uri_value = $value)'''
+        else:
+            uri_clause = ''
+        options = {"work_ids": SQLArray(scores.keys()), "scheme": scheme,
+                   "value": value}
+        options.update(params)
+        q = '''SELECT work_id, work_type, uri_scheme, uri_value, canonical
+               FROM work INNER JOIN work_uri USING(work_id)
+               WHERE work_id = ANY($work_ids) ''' + clause + uri_clause
+        results = do_prepared(q, options, 'lookup')
+        for e in results:
+            e["score"] = scores[e["work_id"]]
+        return sorted(results, key=lambda e: (e["score"], not e["canonical"]))
+
+
+def subscribe(index):
+    """Apply the changes made by this process to its index straight away"""
+    events.subscribe(events.WORK_SAVED, index.add)
+    events.subscribe(events.TITLES_DELETED, index.remove)
+    events.subscribe(events.WORK_DELETED, index.remove)
@@ -1,19 +1,64 @@
+import os
+import time
+import threading
 import web
+import metrics
 from aux import logger_instance, debug_mode
 from api import db
 
 logger = logger_instance(__name__)
 web.config.debug = debug_mode()
 
+# seconds after which reference tables are reloaded
+REFERENCE_DATA_TTL = int(os.getenv('REFERENCE_DATA_TTL', 3600))
+
+
+class ReferenceSet():
+    """In-process copy of the values of a small, rarely changing table.
+
+    The values are loaded on first use and reloaded every `ttl` seconds, or
+    when looking up a value that is not in the copy - at most once every
+    `min_reload` seconds - so that new values are picked up promptly.
+    """
+
+    def __init__(self, table_name, ttl=REFERENCE_DATA_TTL, min_reload=10):
+        self.table_name = table_name
+        self.ttl        = ttl
+        self.min_reload = min_reload
+        self.values     = frozenset()
+        self.loaded_at  = None
+        self.lock       = threading.Lock()
+        metrics.register_counter('reference_data.%s.reloads' % (table_name))
+
+    def load(self):
+        results = db.select(self.table_name, what=self.table_name)
+        values = frozenset(e[self.table_name] for e in results)
+        with self.lock:
+            self.values, self.loaded_at = values, time.time()
+        metrics.increment('reference_data.%s.reloads' % (self.table_name))
+
+    def get(self):
+        expired = self.loaded_at and self.loaded_at + self.ttl < time.time()
+        if not self.loaded_at or expired:
+            self.load()
+        return self.values
+
+    def __contains__(self, value):
+        if value in self.get():
+            return True
+        # the value may have been added since the copy was loaded
+        if self.loaded_at + self.min_reload < time.time():
+            self.load()
+            return value in self.values
+        return False
+
 
 class UnaryTable():
     table_name = ""
+    values = None  # ReferenceSet of the table
 
     def exists(self):
         try:
-            where = "%s = $%s" % (self.table_name, self.table_name)
-            result = db.select(self.table_name, self.__dict__, where=where)
-            candidate = self.__dict__[self.table_name]
-            return result.first()[self.table_name] == candidate
+            return self.__dict__[self.table_name] in self.values
         except BaseException:
             return False
@@ -0,0 +1,131 @@
+import math
+import struct
+import hashlib
+import threading
+import web
+import events
+import metrics
+from aux import logger_instance, debug_mode
+from . import changefeed
+from .snapshot import uri_key
+from .operations import do_query, stream_query
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+
+class BloomFilter():
+    """Bloom filter of strings, sized for `capacity` items with a rate of
+    false positives of `error_rate`"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        bits_per_item = -math.log(error_rate) / (math.log(2) ** 2)
+        self.size   = int(math.ceil(capacity * bits_per_item))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits   = bytearray((self.size + 7) // 8)
+
+    def positions(self, item):
+        # double hashing: the i-th position is h1 + i * h2
+        h1, h2 = struct.unpack('<QQ',
+                               hashlib.md5(item.encode('utf-8')).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(item))
+
+
+class UriFilter():
+    """Bloom filter of all the URIs of works, telling which are unknown.
+
+    A URI not in the filter is definitely not stored, so its lookups may be
+    answered without querying the database; one in the filter may or may
+    not be. The filter is built by a ChangeFeed, which adds the URIs of the
+    works changed through the API as they are notified, and rebuilt every
+    `ttl` seconds (which also drops deleted URIs) - sized with `headroom`
+    for the URIs added in between. All URIs may be stored while the filter
+    is not built, while the feed is not listening (notifications may be
+    missed), and while the filter is being rebuilt or notified works are
+    being added (notifications are not applied yet).
+    """
+
+    def __init__(self, ttl=900, error_rate=0.01, headroom=1.2):
+        self.error_rate = error_rate
+        self.headroom   = headroom
+        self.bloom      = None
+        self.loading    = None  # URIs added while (re)building the filter
+        self.updating   = 0     # rebuilds and updates being applied
+        self.lock       = threading.Lock()
+        self.feed       = changefeed.ChangeFeed('uri_filter', self.load,
+                                                self.update, ttl)
+        metrics.register_counter('uri_filter.rejections')
+        metrics.register_counter('uri_filter.reloads')
+
+    def load(self):
+        with self.lock:
+            self.loading = []
+            # notifications wait until the filter is rebuilt
+            self.updating += 1
+        try:
+            count = do_query("SELECT count(*) AS count FROM work_uri", {})
+            capacity = int(count.first()["count"] * self.headroom) + 1000
+            bloom = BloomFilter(capacity, self.error_rate)
+            for e in stream_query('''SELECT uri_scheme, uri_value
+                                     FROM work_uri''', {}, itersize=10000):
+                bloom.add(uri_key(e["uri_scheme"], e["uri_value"]))
+            with self.lock:
+                # the URIs saved meanwhile may not have been read
+                for key in self.loading:
+                    bloom.add(key)
+                self.bloom = bloom
+        finally:
+            with self.lock:
+                self.loading = None
+                self.updating -= 1
+        metrics.increment('uri_filter.reloads')
+
+    def update(self, work_ids):
+        """Add the URIs of the given works"""
+        from .work import Work
+        with self.lock:
+            self.updating += 1
+        try:
+            for row in Work.get_by_work_id(work_ids).values():
+                self.add([(e["uri_scheme"], e["uri_value"])
+                          for e in row["uris"]])
+        finally:
+            with self.lock:
+                self.updating -= 1
+
+    def add(self, uris):
+        with self.lock:
+            for scheme, value in uris:
+                key = uri_key(scheme, value)
+                if self.bloom is not None:
+                    self.bloom.add(key)
+                if self.loading is not None:
+                    self.loading.append(key)
+
+    def saved(self, work_id, uris=[], titles=[]):
+        self.add(uris)
+
+    def may_exist(self, scheme, value):
+        """Tell whether a URI may be stored, False if it definitely is not"""
+        self.feed.ensure_started()
+        bloom = self.bloom
+        if bloom is None or not self.feed.listening or self.updating:
+            return True
+        if uri_key(scheme, value) in bloom:
+            return True
+        metrics.increment('uri_filter.rejections')
+        return False
+
+
+def subscribe(uri_filter):
+    """Add the URIs saved by this process to its filter straight away"""
+    events.subscribe(events.WORK_SAVED, uri_filter.saved)
@@ -1,8 +1,7 @@
 import web
 from aux import logger_instance, debug_mode
-from api import db
 from errors import Error, BADPARAMS
-from .unarytable import UnaryTable
+from .unarytable import UnaryTable, ReferenceSet
 
 logger = logger_instance(__name__)
 web.config.debug = debug_mode()
@@ -10,13 +9,15 @@ web.config.debug = debug_mode()
 
 class UriScheme(UnaryTable):
     table_name = "uri_scheme"
+    values = ReferenceSet(table_name)
 
     def __init__(self, uri_scheme):
         self.uri_scheme = uri_scheme
 
     @staticmethod
     def get_all():
-        return db.select(UriScheme.table_name)
+        return [{UriScheme.table_name: value}
+                for value in sorted(UriScheme.values.get())]
 
     @staticmethod
     def find_or_fail(uri_scheme):
@@ -1,20 +1,25 @@
 import web
 import psycopg2
-from aux import logger_instance, debug_mode, strtolist
+import events
+from uuid import UUID
+from aux import logger_instance, debug_mode, strtolist, generate_uuid
 from api import db
 from errors import Error, FATAL, BADPARAMS
-from .operations import results_to_identifiers, do_query
+from validation import require_params_or_fail
+from dbtypes import SQLArray
+from .operations import results_to_identifiers, do_prepared, stream_query
+from . import changefeed
 
 logger = logger_instance(__name__)
 web.config.debug = debug_mode()
 
 
 class Work():
-    def __init__(self, work_id, work_type=None, titles=[], uris=[]):
+    def __init__(self, work_id, work_type=None, titles=None, uris=[]):
         self.UUID   = work_id
         self.type   = work_type if work_type else self.get_type()
         self.URI    = uris
-        self.title  = titles if titles else self.get_titles()
+        self.title  = titles if titles is not None else self.get_titles()
 
     def get_type(self):
         options = dict(uuid=self.UUID)
@@ -47,12 +52,24 @@ class Work():
         options = dict(uuid=self.UUID)
         return db.select('work_relation', options, what=key, where=where[key])
 
+    def get_uri_parts(self):
+        """Get the [scheme, value] of each URI set in this object"""
+        from .identifier import Identifier
+        return [Identifier.split_uri(i.get('URI') or i.get('uri'))
+                for i in self.URI]
+
     def load_identifiers(self):
         self.URI = self.get_identifiers()
 
     def load_titles(self):
         self.title = self.get_titles()
 
+    def reload(self):
+        """Load the current titles and URIs of the work in a single query"""
+        row = Work.get_by_work_id([self.UUID]).get(self.UUID)
+        self.title = row["titles"] if row else []
+        self.URI = results_to_identifiers(row["uris"]) if row else []
+
     def set_attribute(self, attribute, value):
         self.__dict__.update({attribute: value})
 
@@ -76,12 +93,13 @@ class Work():
 
     def check_and_set_relatives(self, parent=[], child=[]):
         relatives = {'parent_work_id': parent, 'child_work_id': child}
-        for name, group in relatives.items():
-            if group:
-                elements = strtolist(group)
-                for e in elements:
-                    Work.find_or_fail(e)
-                self.set_relatives(name, elements)
+        relatives = dict((name, strtolist(group))
+                         for name, group in relatives.items() if group)
+        missing = Work.get_missing(sum(relatives.values(), []))
+        if missing:
+            raise Error(BADPARAMS, msg="Unknown work '%s'" % (missing[0]))
+        for name, elements in relatives.items():
+            self.set_relatives(name, elements)
 
     def set_children(self, children):
         self.set_attribute('child', children)
@@ -90,51 +108,69 @@ class Work():
         self.set_attribute('parent', parents)
 
     def save(self):
+        """Store the work, its titles, URIs and relations.
+
+        Each table is written with a single (multi-row) statement, whatever
+        the number of titles, URIs and relatives.
+        """
         from .title import Title
         from .identifier import Identifier
+        uris = self.get_uri_parts()
+        canonicals = [i['canonical'] for i in self.URI]
+        relations = [(self.UUID, c) for c in getattr(self, 'child', [])]
+        relations += [(p, self.UUID) for p in getattr(self, 'parent', [])]
         try:
             with db.transaction():
-                q = '''INSERT INTO work (work_id, work_type)
-                       VALUES ($work_id, $work_type) ON CONFLICT DO NOTHING'''
-                db.query(q, dict(work_id=self.UUID, work_type=self.type))
-                if not self.exists():
+                # the work is returned whether it is inserted or existed
+                q = '''WITH inserted AS (
+                           INSERT INTO work (work_id, work_type)
+                           VALUES ($work_id, $work_type)
+                           ON CONFLICT DO NOTHING RETURNING work_id)
+                       SELECT work_id FROM inserted
+                       UNION ALL
+                       SELECT work_id FROM work WHERE work_id = $work_id'''
+                saved = db.query(q, dict(work_id=self.UUID,
+                                         work_type=self.type))
+                if not saved:
                     logger.error('Could not save record.')
                     raise Error(FATAL)
 
-                for title in self.title:
-                    t = Title(title)
-                    t.save_if_not_exists()
+                if self.title:
+                    Title.save_all_if_not_exist(self.title)
                     q = '''INSERT INTO work_title (work_id, title)
-                           VALUES ($work_id, $title) ON CONFLICT DO NOTHING'''
-                    db.query(q, dict(work_id=self.UUID, title=title))
-
-                for i in self.URI:
-                    uri = i.get('URI') or i.get('uri')
-                    is_canonical = i['canonical']
-                    scheme, value = Identifier.split_uri(uri)
-                    Identifier.insert_if_not_exist(scheme, value)
-                    q = '''INSERT INTO work_uri (work_id, uri_scheme, uri_value,
-                           canonical) VALUES
-                           ($work_id, $uri_scheme, $uri_value, $canonical)
+                           SELECT $work_id::uuid, unnest($titles::text[])
                            ON CONFLICT DO NOTHING'''
-                    db.query(q, dict(work_id=self.UUID, uri_scheme=scheme,
-                                     uri_value=value, canonical=is_canonical))
+                    db.query(q, dict(work_id=self.UUID,
+                                     titles=SQLArray(self.title)))
 
-                try:
-                    for c in self.child:
-                        db.insert('work_relation', parent_work_id=self.UUID,
-                                  child_work_id=c)
-                except AttributeError:
-                    pass
-                try:
-                    for p in self.parent:
-                        db.insert('work_relation', parent_work_id=p,
-                                  child_work_id=self.UUID)
-                except AttributeError:
-                    pass
+                if uris:
+                    Identifier.insert_all_if_not_exist(uris)
+                    q = '''INSERT INTO work_uri (work_id, uri_scheme,
+                           uri_value, canonical)
+                           SELECT $work_id::uuid, * FROM unnest(
+                               $schemes::text[], $values::text[],
+                               $canonicals::boolean[])
+                           ON CONFLICT DO NOTHING'''
+                    db.query(q, dict(work_id=self.UUID,
+                                     schemes=SQLArray([s for s, _ in uris]),
+                                     values=SQLArray([v for _, v in uris]),
+                                     canonicals=SQLArray(canonicals)))
+
+                if relations:
+                    q = '''INSERT INTO work_relation (parent_work_id,
+                           child_work_id)
+                           SELECT * FROM unnest($parents::uuid[],
+                                                $children::uuid[])'''
+                    db.query(q, dict(
+                        parents=SQLArray([p for p, _ in relations]),
+                        children=SQLArray([c for _, c in relations])))
+
+                changefeed.notify([self.UUID])
         except (Exception, psycopg2.DatabaseError) as error:
             logger.debug(error)
             raise Error(FATAL)
+        events.publish(events.WORK_SAVED, self.UUID, uris=uris,
+                       titles=self.title)
 
     def exists(self):
         try:
@@ -146,34 +182,135 @@ class Work():
 
     def delete_uris(self):
         from .identifier import Identifier
-        for i in self.URI:
-            uri = i.get('URI') or i.get('uri')
-            scheme, value = Identifier.split_uri(uri)
-            q = '''DELETE FROM work_uri WHERE work_id = $work_id
-                    AND uri_scheme = $scheme AND uri_value = $value'''
-            db.query(q, dict(work_id=self.UUID, scheme=scheme, value=value))
-            # now we delete the URI if it's not linked to other work
-            q = '''DELETE FROM uri WHERE
-                    uri_scheme = $scheme AND uri_value = $value'''
-            try:
-                db.query(q, dict(scheme=scheme, value=value))
-            except BaseException:
-                pass
+        with db.transaction():
+            for i in self.URI:
+                uri = i.get('URI') or i.get('uri')
+                scheme, value = Identifier.split_uri(uri)
+                q = '''DELETE FROM work_uri WHERE work_id = $work_id
+                        AND uri_scheme = $scheme AND uri_value = $value'''
+                db.query(q, dict(work_id=self.UUID, scheme=scheme,
+                                 value=value))
+                # now we delete the URI if it's not linked to other work,
+                # in a savepoint not to abort the transaction if it is
+                q = '''DELETE FROM uri WHERE
+                        uri_scheme = $scheme AND uri_value = $value'''
+                try:
+                    with db.transaction():
+                        db.query(q, dict(scheme=scheme, value=value))
+                except BaseException:
+                    pass
+            changefeed.notify([self.UUID])
+        events.publish(events.URIS_DELETED, self.UUID,
+                       uris=self.get_uri_parts())
 
     def delete_titles(self):
-        for title in self.title:
-            q = '''DELETE FROM work_title WHERE work_id = $work_id
-                    AND title = $title'''
-            db.query(q, dict(work_id=self.UUID, title=title))
-            # now we delete the title if it's not linked to other work
-            try:
-                db.delete('title', dict(title=title), where="title=$title")
-            except BaseException:
-                pass
+        with db.transaction():
+            for title in self.title:
+                q = '''DELETE FROM work_title WHERE work_id = $work_id
+                        AND title = $title'''
+                db.query(q, dict(work_id=self.UUID, title=title))
+                # now we delete the title if it's not linked to other work,
+                # in a savepoint not to abort the transaction if it is
+                try:
+                    with db.transaction():
+                        db.delete('title', dict(title=title),
+                                  where="title=$title")
+                except BaseException:
+                    pass
+            changefeed.notify([self.UUID])
+        events.publish(events.TITLES_DELETED, self.UUID, titles=self.title)
 
     def delete(self):
         q = '''DELETE FROM work WHERE work_id = $work_id'''
-        db.query(q, dict(work_id=self.UUID))
+        with db.transaction():
+            db.query(q, dict(work_id=self.UUID))
+            changefeed.notify([self.UUID])
+        events.publish(events.WORK_DELETED, self.UUID)
+
+    @staticmethod
+    def get_by_work_id(work_ids):
+        """Get the type, titles, URIs and relatives of works in a single query.
+
+        Returns a dictionary of work_id -> row, with `work_type`, `titles`,
+        `uris`, `children` and `parents`. Works that do not exist (including
+        invalid UUIDs) are not included.
+        """
+        uuids = normalise_uuids(work_ids)
+        if not uuids:
+            return {}
+        q = '''SELECT work_id, work_type,
+                      COALESCE((SELECT array_agg(title ORDER BY title)
+                                FROM work_title
+                                WHERE work_title.work_id = work.work_id),
+                               '{}') AS titles,
+                      COALESCE((SELECT json_agg(json_build_object(
+                                           'uri_scheme', uri_scheme,
+                                           'uri_value', uri_value,
+                                           'canonical', canonical)
+                                       ORDER BY uri_scheme, uri_value)
+                                FROM work_uri
+                                WHERE work_uri.work_id = work.work_id),
+                               '[]') AS uris,
+                      COALESCE((SELECT array_agg(child_work_id::text)
+                                FROM work_relation
+                                WHERE parent_work_id = work.work_id),
+                               '{}') AS children,
+                      COALESCE((SELECT array_agg(parent_work_id::text)
+                                FROM work_relation
+                                WHERE child_work_id = work.work_id),
+                               '{}') AS parents
+                FROM work
+                WHERE work_id = ANY($uuids);'''
+        results = do_prepared(q, dict(uuids=SQLArray(uuids)))
+        return dict((e["work_id"], e) for e in results)
+
+    @staticmethod
+    def get_missing(work_ids):
+        """Get the ids, out of those given, of works that do not exist"""
+        uuids = normalise_uuids(work_ids)
+        existing = set()
+        if uuids:
+            q = '''SELECT work_id FROM work WHERE work_id = ANY($uuids);'''
+            results = do_prepared(q, dict(uuids=SQLArray(uuids)))
+            existing = set(e["work_id"] for e in results)
+        return [work_id for work_id in work_ids
+                if normalise_uuid(work_id) not in existing]
+
+    @staticmethod
+    def get_titles_by_work_id(work_ids):
+        """Get the titles of multiple works in a single query."""
+        titles = {}
+        if not work_ids:
+            return titles
+        options = dict(uuids=SQLArray(work_ids))
+        results = db.select('work_title', options, what="work_id, title",
+                            where="work_id = ANY($uuids)")
+        for e in results:
+            titles.setdefault(e["work_id"], []).append(e["title"])
+        return titles
+
+    @staticmethod
+    def get_relatives_by_work_id(work_ids):
+        """Get the children and parents of multiple works in a single query.
+
+        Returns a dictionary of work_id -> {'child': [...], 'parent': [...]}
+        """
+        relatives = dict((work_id, {'child': [], 'parent': []})
+                         for work_id in work_ids)
+        if not work_ids:
+            return relatives
+        options = dict(uuids=SQLArray(work_ids))
+        results = db.select('work_relation', options,
+                            what="parent_work_id, child_work_id",
+                            where='''parent_work_id = ANY($uuids)
+                                     OR child_work_id = ANY($uuids)''')
+        for e in results:
+            parent, child = e["parent_work_id"], e["child_work_id"]
+            if parent in relatives:
+                relatives[parent]['child'].append(child)
+            if child in relatives:
+                relatives[child]['parent'].append(parent)
+        return relatives
 
     @staticmethod
     def get_from_work_id(work_id):
@@ -182,18 +319,115 @@ class Work():
         return Work.get_all(clause, params)
 
     @staticmethod
-    def get_all(clause, params):
-        q = '''SELECT DISTINCT(work.work_id), work_type, title, uri_scheme,
-                      uri_value, canonical
-                FROM work LEFT JOIN work_uri USING(work_id)
-                    LEFT JOIN work_title USING(work_id)
-                WHERE 1=1 ''' + clause + '''
+    def get_all(clause, params, after=None, limit=None, stream=False):
+        """Get the works matching the filters, with their titles and URIs.
+
+        Each row is a work, with its titles and URIs aggregated in the
+        `titles` and `uris` columns. Works may be paged by work_id: `after`
+        skips the works up to the one given and `limit` sets the maximum
+        number of works. With `stream` rows are read from a server-side
+        cursor as they are iterated.
+        """
+        options = dict(params, after=after, limit=limit)
+        page = ' AND work_id > $after' if after else ''
+        q = '''SELECT work_id, work_type, uris,
+                      COALESCE((SELECT array_agg(DISTINCT title)
+                                FROM work_title
+                                WHERE work_title.work_id = work.work_id),
+                               '{}') AS titles
+                FROM (
+                    SELECT work_id, work_type,
+                           COALESCE(json_agg(json_build_object(
+                                        'uri_scheme', uri_scheme,
+                                        'uri_value', uri_value,
+                                        'canonical', canonical)
+                                    ORDER BY uri_scheme, uri_value)
+                                    FILTER (WHERE uri_scheme IS NOT NULL),
+                                    '[]') AS uris
+                    FROM work LEFT JOIN work_uri USING(work_id)
+                    WHERE 1=1 ''' + clause + page + '''
+                    GROUP BY work_id, work_type
+                    ORDER BY work_id
+                    ''' + (' LIMIT $limit' if limit else '') + '''
+                ) work
                 ORDER BY work_id;'''
-        return do_query(q, params)
+        if stream:
+            return stream_query(q, options)
+        return do_prepared(q, options)
+
+    @staticmethod
+    def from_input(data, work_id=None):
+        """Validate the input data of a new work, returning an unsaved Work.
+
+        The work type and the URI schemes must exist, URIs are normalised and
+        their canonical flag set. Relatives are not checked.
+        """
+        from .identifier import Identifier
+        from .worktype import WorkType
+        from .urischeme import UriScheme
+        wtype  = data.get('type', '')
+        title  = data.get('title')
+        uri    = data.get('URI') or data.get('uri')
+
+        titles = strtolist(title) or []
+        uris   = strtolist(uri) or []
+        require_params_or_fail([wtype], 'a (work) type')
+        require_params_or_fail([titles] + titles, 'at least one title')
+        require_params_or_fail([uris] + uris, 'at least one URI')
+        if not all(isinstance(t, str) for t in titles):
+            raise Error(BADPARAMS, msg="Titles must be strings")
+        WorkType.find_or_fail(wtype)
+
+        for i in uris:
+            if not isinstance(i, dict):
+                raise Error(BADPARAMS, msg="URIs must be objects")
+            # attempt to get scheme from URI
+            ident = None
+            try:
+                ident = i.get('URI') or i.get('uri')
+                scheme, value = Identifier.split_uri(ident)
+                try:
+                    i['canonical'] = i['canonical'] in (True, "true", "True")
+                except Exception:
+                    i['canonical'] = False
+            except Exception:
+                identifier = ident if ident else ''
+                raise Error(BADPARAMS, msg="Invalid URI '%s'" % (identifier))
+            # check whether the URI scheme exists in the database
+            UriScheme.find_or_fail(scheme)
+
+        return Work(work_id or generate_uuid(), wtype, titles, uris)
+
+    @staticmethod
+    def find_or_fail(work_id, wtype=None, titles=None, uris=[]):
+        return Work.find_all_or_fail([work_id], wtype, titles, uris)[0]
 
     @staticmethod
-    def find_or_fail(work_id, wtype=None, titles=[], uris=[]):
-        work = Work(work_id, work_type=wtype, titles=titles, uris=uris)
-        if not work.exists():
-            raise Error(BADPARAMS, msg="Unknown work '%s'" % (work_id))
-        return work
+    def find_all_or_fail(work_ids, wtype=None, titles=None, uris=[]):
+        """Get the given works, loaded in a single query.
+
+        `wtype`, `titles` and `uris` are set in all the works returned, if
+        provided, instead of the stored ones.
+        """
+        rows = Work.get_by_work_id(work_ids)
+        works = []
+        for work_id in work_ids:
+            row = rows.get(normalise_uuid(work_id))
+            if row is None:
+                raise Error(BADPARAMS, msg="Unknown work '%s'" % (work_id))
+            work_titles = titles if titles is not None else row["titles"]
+            works.append(Work(row["work_id"], wtype or row["work_type"],
+                              work_titles, uris))
+        return works
+
+
+def normalise_uuid(work_id):
+    """Get the canonical form of a UUID, or None if it is not valid"""
+    try:
+        return str(UUID(work_id))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def normalise_uuids(work_ids):
+    return sorted(set(filter(None, map(normalise_uuid, work_ids))))
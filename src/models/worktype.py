@@ -1,8 +1,7 @@
 import web
 from aux import logger_instance, debug_mode
-from api import db
 from errors import Error, BADPARAMS
-from .unarytable import UnaryTable
+from .unarytable import UnaryTable, ReferenceSet
 
 logger = logger_instance(__name__)
 web.config.debug = debug_mode()
@@ -10,13 +9,15 @@ web.config.debug = debug_mode()
 
 class WorkType(UnaryTable):
     table_name = "work_type"
+    values = ReferenceSet(table_name)
 
     def __init__(self, work_type):
         self.work_type = work_type
 
     @staticmethod
     def get_all():
-        return db.select(WorkType.table_name)
+        return [{WorkType.table_name: value}
+                for value in sorted(WorkType.values.get())]
 
     @staticmethod
     def find_or_fail(work_type):
@@ -3,6 +3,7 @@ from aux import logger_instance, debug_mode
 from validation import require_params_or_fail
 from api import json, json_response, api_response, check_token
 from models.work import Work
+from models.operations import results_to_works
 
 logger = logger_instance(__name__)
 web.config.debug = debug_mode()
@@ -23,18 +24,13 @@ class RelationsController():
         require_params_or_fail([parent_uuid, child_uuid],
                                'a parent and a child UUID')
 
-        parent = Work.find_or_fail(parent_uuid)
-        child = Work.find_or_fail(child_uuid)
+        parent, child = Work.find_all_or_fail([parent_uuid, child_uuid])
 
         parent.set_children([child.UUID])
         parent.save()
 
-        parent.load_titles()
-        parent.load_identifiers()
-        parent.load_children()
-        parent.load_parents()
-
-        return [parent.__dict__]
+        results = Work.get_from_work_id(parent.UUID)
+        return results_to_works(results, include_relatives=True)
 
     @json_response
     def OPTIONS(self, name):
@@ -36,8 +36,7 @@ class TitlesController():
 
         work = Work.find_or_fail(work_id, titles=titles)
         work.save()
-        work.load_titles()
-        work.load_identifiers()
+        work.reload()
 
         return [work.__dict__]
 
@@ -53,8 +52,7 @@ class TitlesController():
 
         work = Work.find_or_fail(work_id, titles=[title])
         work.delete_titles()
-        work.load_titles()
-        work.load_identifiers()
+        work.reload()
 
         return [work.__dict__]
 
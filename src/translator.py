@@ -1,17 +1,31 @@
+import os
 import web
+import json
+import threading
 import urllib.parse
 import urllib.error
 import urllib.request
 from aux import logger_instance, debug_mode
 from validation import require_params_or_fail
-from api import build_parms, json_response, api_response, check_token
-from errors import Error, BADPARAMS, NORESULT, AMBIGUOUS, NONCANONICAL
+from api import (build_parms, json_response, api_response, check_token,
+                 read_only)
+from errors import (Error, BADPARAMS, BADFILTERS, NORESULT, AMBIGUOUS,
+                    NONCANONICAL, UNAVAILABLE)
 from models.identifier import Identifier
-from models.operations import results_to_identifiers, result_to_identifier
+from models.operations import (results_to_identifiers, result_to_identifier,
+                               preload_works)
 
 logger = logger_instance(__name__)
 web.config.debug = debug_mode()
 
+# Maximum number of items accepted by a single batch translation request
+BATCH_LIMIT = int(os.getenv('TRANSLATE_BATCH_LIMIT', 10000))
+
+# Maximum number of title searches run at once by each process, the other
+# threads of the process are left to URI lookups
+SEARCH_LIMIT = int(os.getenv('TITLE_SEARCH_CONCURRENCY', 2))
+searches = threading.BoundedSemaphore(SEARCH_LIMIT)
+
 
 class Translator():
     """Handles translation queries"""
@@ -36,7 +50,98 @@ class Translator():
         title   = web.input().get('title')
         filters = web.input().get('filter')
         strict  = web.input().get('strict') in ("true", "True")
+        match   = web.input().get('match', Identifier.TIERED)
+
+        scheme, value, title = self.parse_input(uri, title)
+        self.validate_match(match)
+        clause, params = build_parms(filters)
+
+        results = self.query(scheme, value, title, clause, params, match,
+                             strict)
+        if not results:
+            raise Error(NORESULT)
 
+        return self.process_results(list(results), strict)
+
+    @json_response
+    @api_response
+    @check_token
+    @read_only
+    def POST(self, name):
+        """Translate a batch of URIs and/or titles.
+
+        Takes a JSON array of objects with the same parameters as GET (`uri`
+        and/or `title`, `filter`, `strict`) and outputs one response object
+        per item, in the same order. URI items sharing the same filter are
+        resolved together in a single query. A failing item (e.g. NORESULT,
+        AMBIGUOUS) is reported in its own response object and does not
+        affect the rest of the batch.
+        """
+        try:
+            items = json.loads(web.data().decode('utf-8'))
+            assert isinstance(items, list) and items
+            assert all(isinstance(item, dict) for item in items)
+        except Exception:
+            raise Error(BADPARAMS, msg="You must provide an array of objects")
+        if len(items) > BATCH_LIMIT:
+            msg = "Batches are limited to %d items" % (BATCH_LIMIT)
+            raise Error(BADPARAMS, msg=msg)
+
+        # keep the response status and headers, as Error modifies them
+        status, headers = web.ctx.status, list(web.ctx.headers)
+        output = [None] * len(items)
+        lookups = {}  # filters -> list of (index, scheme, value, strict)
+
+        for i, item in enumerate(items):
+            try:
+                uri     = item.get('uri') or item.get('URI')
+                title   = item.get('title')
+                filters = item.get('filter')
+                strict  = item.get('strict') in (True, "true", "True")
+                match   = item.get('match', Identifier.TIERED)
+                scheme, value, title = self.parse_input(uri, title)
+                self.validate_match(match)
+                if filters is not None and not isinstance(filters, str):
+                    raise Error(BADFILTERS)
+                clause, params = build_parms(filters)
+            except Error as error:
+                output[i] = self.item_error(error, item, status, headers)
+                continue
+
+            if title:
+                # title searches cannot be grouped, they are run one by one
+                try:
+                    results = self.query(scheme, value, title, clause,
+                                         params, match, strict)
+                except Error as error:
+                    output[i] = self.item_error(error, item, status, headers)
+                    continue
+                output[i] = self.item_response(item, status, headers,
+                                               results, strict)
+            else:
+                lookups.setdefault(filters, []).append(
+                    (i, scheme, value, strict))
+
+        for filters, group in lookups.items():
+            clause, params = build_parms(filters)
+            uris = set((scheme, value) for _, scheme, value, _ in group)
+            matches = {}
+            for e in Identifier.get_from_uris(list(uris), clause, params):
+                key = (e["input_scheme"], e["input_value"])
+                matches.setdefault(key, []).append(e)
+            for i, scheme, value, strict in group:
+                results = matches.get((scheme, value), [])
+                output[i] = self.item_response(items[i], status, headers,
+                                               results, strict)
+        return output
+
+    def parse_input(self, uri, title):
+        """Validate the URI and/or title of a query.
+
+        Returns the scheme and value of the URI (if any) and the unquoted
+        title (if any).
+        """
+        scheme = value = None
         try:
             if uri:
                 scheme, value = Identifier.split_uri(uri)
@@ -48,21 +153,63 @@ class Translator():
                 raise Error
         except BaseException:
             raise Error(BADPARAMS, msg="Invalid URI or title provided")
+        return scheme, value, title
 
-        clause, params = build_parms(filters)
+    def validate_match(self, match):
+        if match not in (Identifier.TIERED, Identifier.FUZZY):
+            raise Error(BADPARAMS, msg="Unknown match '%s'" % (match))
 
-        if uri and not title:
-            results = Identifier.get_from_uri(scheme, value, clause, params)
-        elif title and not uri:
-            results = Identifier.get_from_title(title, clause, params)
-        else:
-            results = Identifier.get_from_title(title, clause, params,
-                                                scheme, value)
+    def query(self, scheme, value, title, clause, params,
+              match=Identifier.TIERED, strict=False):
+        """Query by URI, title, or both.
 
-        if not results:
-            raise Error(NORESULT)
+        In strict mode we only need the candidates with the lowest score
+        to choose the best one, so only those are fetched.
+        """
+        if scheme and not title:
+            return Identifier.get_from_uri(scheme, value, clause, params)
+        return self.search(title, clause, params, scheme or '', value or '',
+                           match, strict)
 
-        return self.process_results(list(results), strict)
+    def search(self, title, clause, params, scheme, value, match, strict):
+        """Run a title search, unless too many are running already.
+
+        Searches over the limit are rejected rather than queued, as waiting
+        would still take up a thread that URI lookups need.
+        """
+        if not searches.acquire(blocking=False):
+            msg = "Too many title searches running, please try again later"
+            raise Error(UNAVAILABLE, msg=msg)
+        try:
+            return list(Identifier.get_from_title(title, clause, params,
+                                                  scheme, value, match,
+                                                  strict))
+        finally:
+            searches.release()
+
+    def item_response(self, item, status, headers, results, strict):
+        """Process the results of a batch item, capturing errors."""
+        try:
+            results = list(results)
+            if not results:
+                raise Error(NORESULT)
+            data = self.process_results(results, strict)
+            return {'status': 'ok', 'code': 200, 'count': len(data),
+                    'data': data, 'input': item}
+        except Error as error:
+            return self.item_error(error, item, status, headers)
+
+    def item_error(self, error, item, status, headers):
+        """Convert an Error into a batch item response.
+
+        Instantiating an Error sets the status and headers of the response,
+        we restore them so that the batch itself is still successful.
+        """
+        web.ctx.status, web.ctx.headers = status, list(headers)
+        output = json.loads(error.data)
+        output.pop('parameters', None)
+        output['input'] = item
+        return output
 
     def process_results(self, results, strict):
         """Convert results from query to objects.
@@ -83,6 +230,7 @@ class Translator():
             # process multiple results in strict mode
             logger.debug("Warning: multiple results in strict mode. "
                          "Choosing best candidate...")
+            preload_works(results)
             return [self.choose_best_candidate(results).__dict__]
 
     def choose_best_candidate(self, results):
@@ -36,7 +36,7 @@ class UrisController():
 
         work = Work.find_or_fail(work_id, uris=uris)
         work.save()
-        work.load_identifiers()
+        work.reload()
 
         return [work.__dict__]
 
@@ -56,9 +56,9 @@ class UrisController():
         except Exception:
             raise Error(BADPARAMS, msg="Invalid URI '%s'" % (uri))
 
-        work = Work.find_or_fail(work_id, uris)
+        work = Work.find_or_fail(work_id, uris=uris)
 
         work.delete_uris()
-        work.load_identifiers()
+        work.reload()
 
         return [work.__dict__]
@@ -1,14 +1,12 @@
 import web
-from aux import (logger_instance, debug_mode, sort_alphabetically, strtolist,
-                 generate_uuid)
+from uuid import UUID
+from aux import logger_instance, debug_mode, sort_alphabetically
 from validation import validate_sorting_or_fail, require_params_or_fail
-from api import json, json_response, api_response, check_token, build_parms
-from errors import Error, BADPARAMS, NORESULT
+from api import (json, json_response, ndjson_response, api_response,
+                 check_token, build_parms)
+from errors import Error, BADPARAMS, BADFILTERS, NORESULT
 from models.work import Work
-from models.worktype import WorkType
-from models.identifier import Identifier
-from models.urischeme import UriScheme
-from models.operations import results_to_works
+from models.operations import results_to_works, iter_works
 
 logger = logger_instance(__name__)
 web.config.debug = debug_mode()
@@ -17,11 +15,21 @@ web.config.debug = debug_mode()
 class WorksController():
     """Handles work related actions"""
 
+    def GET(self, name):
+        """List a work if UUID provided otherwise list all works.
+
+        Works may be paged with `limit` and `after` (the UUID of the last work
+        of the previous page), or streamed as newline delimited JSON. Use
+        `include=relatives` to list the children and parents of each work.
+        """
+        if web.input().get('stream') in ("true", "True"):
+            return self.stream_works(name)
+        return self.get_works(name)
+
     @json_response
     @api_response
     @check_token
-    def GET(self, name):
-        """List a work if UUID provided otherwise list all works"""
+    def get_works(self, name):
         work_id = web.input().get('uuid') or web.input().get('UUID')
 
         if work_id:
@@ -31,15 +39,20 @@ class WorksController():
             filters = web.input().get('filter')
             sort = web.input().get('sort')
             order = web.input().get('order', 'asc')
+            after, limit = self.get_page()
             clause, params = build_parms(filters)
             if sort:
                 validate_sorting_or_fail(["title"], sort, order)
-            results = Work.get_all(clause, params)
+                # pages are ordered by UUID, sorting them would mix orders
+                if after or limit:
+                    raise Error(BADFILTERS,
+                                msg="Paged works cannot be sorted")
+            results = Work.get_all(clause, params, after, limit)
 
         if not results:
             raise Error(NORESULT)
 
-        include_relatives = work_id is not None
+        include_relatives = work_id is not None or self.include_relatives()
         data = results_to_works(results, include_relatives)
 
         if sort:
@@ -47,43 +60,46 @@ class WorksController():
             return sort_alphabetically(data, sort, order)
         return data
 
+    @ndjson_response
+    @check_token
+    def stream_works(self, name):
+        """Stream all works, reading them from a server-side cursor"""
+        filters = web.input().get('filter')
+        if web.input().get('sort'):
+            raise Error(BADFILTERS, msg="Streamed works cannot be sorted")
+        after, limit = self.get_page()
+        clause, params = build_parms(filters)
+        results = Work.get_all(clause, params, after, limit, stream=True)
+        return iter_works(results, self.include_relatives())
+
+    def include_relatives(self):
+        include = web.input().get('include', '')
+        return 'relatives' in include.split(',')
+
+    def get_page(self):
+        after = web.input().get('after')
+        limit = web.input().get('limit')
+        try:
+            if after:
+                after = str(UUID(after))
+            if limit:
+                limit = int(limit)
+                assert limit > 0
+        except Exception:
+            raise Error(BADPARAMS, msg="Invalid page parameters")
+        return after, limit
+
     @json_response
     @api_response
     @check_token
     def POST(self, name):
         """Create a work"""
         data   = json.loads(web.data().decode('utf-8'))
-        wtype  = data.get('type', '')
-        title  = data.get('title')
-        uri    = data.get('URI') or data.get('uri')
         parent = data.get('parent')
         child  = data.get('child')
 
-        titles = strtolist(title)
-        uris   = strtolist(uri)
-        require_params_or_fail([wtype], 'a (work) type')
-        require_params_or_fail(titles, 'at least one title')
-        require_params_or_fail(uris, 'at least one URI')
-        WorkType.find_or_fail(wtype)
-
-        for i in uris:
-            # attempt to get scheme from URI
-            try:
-                ident = i.get('URI') or i.get('uri')
-                scheme, value = Identifier.split_uri(ident)
-                try:
-                    i['canonical'] = i['canonical'] in (True, "true", "True")
-                except Exception:
-                    i['canonical'] = False
-            except Exception:
-                identifier = ident if ident else ''
-                raise Error(BADPARAMS, msg="Invalid URI '%s'" % (identifier))
-            # check whether the URI scheme exists in the database
-            UriScheme.find_or_fail(scheme)
-
         # instantiate a new work with the input data
-        uuid = generate_uuid()
-        work = Work(uuid, wtype, titles, uris)
+        work = Work.from_input(data)
 
         # check relatives and associate them with the work
         work.check_and_set_relatives(parent, child)
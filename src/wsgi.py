@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+WSGI entry point, e.g. `gunicorn --config gunicorn.conf.py wsgi:application`
+"""
+
+import web
+from aux import logger_instance, debug_mode
+from api import create_app
+
+logger = logger_instance(__name__)
+web.config.debug = debug_mode()
+
+application = create_app().wsgifunc()
@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+# the database is not connected to by the tested code
+os.environ.setdefault('JWT_DISABLED', 'true')
+for variable in ('IDENTIFIERSDB_HOST', 'IDENTIFIERSDB_USER',
+                 'IDENTIFIERSDB_PASS', 'IDENTIFIERSDB_DB'):
+    os.environ.setdefault(variable, 'test')
+
+import web  # noqa: E402
+from models import bulk  # noqa: E402
+from models.worktype import WorkType  # noqa: E402
+from models.urischeme import UriScheme  # noqa: E402
+
+URI = [{'URI': 'info:doi:10.1/a', 'canonical': True}]
+
+
+class TestValidate(unittest.TestCase):
+
+    def setUp(self):
+        # errors read and modify the response of the current request
+        web.ctx.env = {'REQUEST_METHOD': 'POST'}
+        web.ctx.data = b''
+        web.ctx.status, web.ctx.headers = '200 OK', []
+        # reference data as if loaded from the database
+        for table, values in ((WorkType, ['book']), (UriScheme, ['info:doi'])):
+            table.values.values = frozenset(values)
+            table.values.loaded_at = time.time()
+
+    def validate(self, record):
+        [(work, error)] = bulk.validate([record], check_stored=False)
+        return work, error
+
+    def assertInvalid(self, record, description):
+        work, error = self.validate(record)
+        self.assertIsNone(work)
+        self.assertEqual(error.httpcode, 400)
+        self.assertEqual(error.description, description)
+
+    def test_valid(self):
+        work, error = self.validate({'type': 'book', 'title': 'A',
+                                     'URI': URI})
+        self.assertIsNone(error)
+        self.assertEqual(work.title, ['A'])
+        self.assertEqual(work.URI, URI)
+
+    def test_uri_string(self):
+        self.assertInvalid({'type': 'book', 'title': 'A',
+                            'URI': 'info:doi:10.1/a'},
+                           "URIs must be objects")
+
+    def test_uri_item_not_object(self):
+        self.assertInvalid({'type': 'book', 'title': 'A',
+                            'URI': URI + ['info:doi:10.1/b']},
+                           "URIs must be objects")
+
+    def test_invalid_uri(self):
+        self.assertInvalid({'type': 'book', 'title': 'A',
+                            'URI': [{'URI': 5}]},
+                           "Invalid URI '5'")
+
+    def test_title_not_string(self):
+        self.assertInvalid({'type': 'book', 'title': 5, 'URI': URI},
+                           "You must provide at least one title")
+        self.assertInvalid({'type': 'book', 'title': ['A', 5], 'URI': URI},
+                           "Titles must be strings")
+
+    def test_missing_title(self):
+        self.assertInvalid({'type': 'book', 'URI': URI},
+                           "You must provide at least one title")
+
+    def test_invalid_record_reported_alone(self):
+        results = bulk.validate([{'type': 'book', 'title': 5, 'URI': URI},
+                                 {'type': 'book', 'title': 'B', 'URI': URI}],
+                                check_stored=False)
+        self.assertEqual([work is None for work, _ in results],
+                         [True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+# the database is not connected to by the tested code
+os.environ.setdefault('JWT_DISABLED', 'true')
+for variable in ('IDENTIFIERSDB_HOST', 'IDENTIFIERSDB_USER',
+                 'IDENTIFIERSDB_PASS', 'IDENTIFIERSDB_DB'):
+    os.environ.setdefault(variable, 'test')
+
+from load import Catalogue, record_uuid, with_uuid  # noqa: E402
+
+CSV = ('type,titles,uris\n'
+       'book,A,info:doi:10.1/a\n'
+       'book,B,info:doi:10.1/b\n'
+       'book,C,info:doi:10.1/c\n')
+
+
+class TestCatalogue(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'catalogue.csv')
+        with open(self.path, 'w') as catalogue:
+            catalogue.write(CSV)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def titles(self, offset=0):
+        with Catalogue(self.path, 'csv', offset) as catalogue:
+            return [record['title'][0] for record in catalogue]
+
+    def test_read_all(self):
+        self.assertEqual(self.titles(), ['A', 'B', 'C'])
+
+    def test_resume(self):
+        with Catalogue(self.path, 'csv') as catalogue:
+            next(iter(catalogue))
+            # the offset saved to the checkpoint after the first record
+            offset = catalogue.offset
+        self.assertEqual(self.titles(offset), ['B', 'C'])
+
+    def work_ids(self, offset=0):
+        with Catalogue(self.path, 'csv', offset) as catalogue:
+            return [record_uuid(self.path, catalogue.start)
+                    for _ in catalogue]
+
+    def test_resume_same_uuids(self):
+        work_ids = self.work_ids()
+        self.assertEqual(len(set(work_ids)), 3)
+        with Catalogue(self.path, 'csv') as catalogue:
+            next(iter(catalogue))
+            offset = catalogue.offset
+        # records loaded again after resuming get the same UUIDs
+        self.assertEqual(self.work_ids(offset), work_ids[1:])
+        self.assertEqual(self.work_ids(0), work_ids)
+
+    def test_uuid_given(self):
+        record = {'type': 'book', 'UUID': 'given'}
+        self.assertEqual(with_uuid(record, 'derived'), record)
+        self.assertEqual(with_uuid({'type': 'book'}, 'derived'),
+                         {'type': 'book', 'UUID': 'derived'})
+        self.assertEqual(with_uuid('invalid', 'derived'), 'invalid')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+import uuid
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+# the database is not connected to by the tested code
+os.environ.setdefault('JWT_DISABLED', 'true')
+for variable in ('IDENTIFIERSDB_HOST', 'IDENTIFIERSDB_USER',
+                 'IDENTIFIERSDB_PASS', 'IDENTIFIERSDB_DB'):
+    os.environ.setdefault(variable, 'test')
+
+from models.snapshot import Snapshot  # noqa: E402
+from models.snapshotfile import MappedSnapshot, write  # noqa: E402
+
+A = str(uuid.UUID(int=1))
+B = str(uuid.UUID(int=2))
+C = str(uuid.UUID(int=3))
+
+
+def row(work_id, work_type, titles, uris):
+    return {'work_id': work_id, 'work_type': work_type, 'titles': titles,
+            'uris': [{'uri_scheme': scheme, 'uri_value': value,
+                      'canonical': canonical}
+                     for scheme, value, canonical in uris]}
+
+
+class TestMappedSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot')
+        self.mapped = []
+
+    def tearDown(self):
+        for snapshot in self.mapped:
+            if snapshot.mapped is not None:
+                snapshot.mapped[1].close()
+        shutil.rmtree(self.directory)
+
+    def snapshot(self, rows):
+        snapshot = Snapshot(ttl=0)
+        # the change feeds are not listened to
+        snapshot.feed = mock.Mock()
+        for e in rows:
+            snapshot.index_work(e)
+        snapshot.loaded_at = time.time()
+        return snapshot
+
+    def mapped_snapshot(self, snapshot):
+        write(self.path, snapshot)
+        mapped = MappedSnapshot(self.path)
+        mapped.feed = mock.Mock()
+        self.mapped.append(mapped)
+        return mapped
+
+    def test_lookup(self):
+        snapshot = self.snapshot([
+            row(A, 'book', ['Title A', 'Ä subtitle'],
+                [('info:doi', '10.1/a', True),
+                 ('urn:isbn', '9780000000001', False),
+                 ('info:doi', '10.1/shared', False)]),
+            row(B, 'book-chapter', ['Title B'],
+                [('info:doi', '10.1/ab', True),
+                 ('info:doi', '10.1/shared', False),
+                 ('https', 'example.org/é', False)]),
+            row(C, 'book', [], [])])
+        mapped = self.mapped_snapshot(snapshot)
+        work_a, work_b = snapshot.works[:2]
+        self.assertEqual(work_a, (A, 'book', ('Title A', 'Ä subtitle'),
+                                  (('info:doi', '10.1/a', True),
+                                   ('urn:isbn', '9780000000001', False),
+                                   ('info:doi', '10.1/shared', False))))
+        uris = [('info:doi', '10.1/a'), ('info:doi', '10.1/ab'),
+                ('info:doi', '10.1/shared'), ('https', 'example.org/é'),
+                ('urn:isbn', '9780000000001'), ('info:doi', '10.1/'),
+                ('info:doi', '10.1/b'), ('info', 'doi:10.1/a')]
+        self.assertEqual(mapped.lookup(uris),
+                         [[work_a], [work_b], [work_a, work_b], [work_b],
+                          [work_a], [], [], []])
+        self.assertEqual(mapped.lookup(uris), snapshot.lookup(uris))
+
+    def test_deleted_work(self):
+        snapshot = self.snapshot([
+            row(A, 'book', ['A'], [('info:doi', '10.1/a', True)]),
+            row(B, 'book', ['B'], [('info:doi', '10.1/b', True)])])
+        snapshot.unindex(A)
+        mapped = self.mapped_snapshot(snapshot)
+        self.assertEqual(mapped.lookup([('info:doi', '10.1/a'),
+                                        ('info:doi', '10.1/b')]),
+                         [[], [snapshot.works[1]]])
+
+    def test_empty(self):
+        mapped = self.mapped_snapshot(self.snapshot([]))
+        self.assertEqual(mapped.lookup([('info:doi', '10.1/a')]), [[]])
+
+    def test_changed(self):
+        snapshot = self.snapshot([
+            row(A, 'book', ['A'], [('info:doi', '10.1/a', True)])])
+        mapped = self.mapped_snapshot(snapshot)
+        mapped.changed(A)
+        # changed works are looked up in the database
+        self.assertIsNone(mapped.lookup([('info:doi', '10.1/a')]))
+        mapped.changed(B, uris=[('info:doi', '10.1/b')])
+        self.assertIsNone(mapped.lookup([('info:doi', '10.1/b')]))
+
+    def test_same_as_in_memory(self):
+        generator = random.Random(0)
+        values = ['10.1/%s' % (generator.choice('abcdefghij') * n)
+                  for n in range(1, 40)]
+        rows = []
+        for i in range(300):
+            uris = set((generator.choice(['info:doi', 'urn:isbn']),
+                        generator.choice(values),
+                        generator.random() < 0.5)
+                       for _ in range(generator.randint(0, 4)))
+            rows.append(row(str(uuid.UUID(int=i)), 'book', ['T%d' % i],
+                            sorted(uris)))
+        snapshot = self.snapshot(rows)
+        mapped = self.mapped_snapshot(snapshot)
+        uris = [(scheme, value) for scheme in ['info:doi', 'urn:isbn']
+                for value in values + ['10.1/', '10.1/k']]
+        self.assertEqual(mapped.lookup(uris), snapshot.lookup(uris))
+
+
+if __name__ == '__main__':
+    unittest.main()
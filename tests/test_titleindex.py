@@ -0,0 +1,158 @@
+import os
+import sys
+import time
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+# the database is not connected to by the tested code
+os.environ.setdefault('JWT_DISABLED', 'true')
+for variable in ('IDENTIFIERSDB_HOST', 'IDENTIFIERSDB_USER',
+                 'IDENTIFIERSDB_PASS', 'IDENTIFIERSDB_DB'):
+    os.environ.setdefault(variable, 'test')
+
+from models.titleindex import (TitleIndex, bounded_levenshtein,  # noqa: E402
+                               EXACT, PREFIX, FUZZY, FUZZY_MAX_BYTES)
+
+KINDS = [[EXACT], [PREFIX], [FUZZY], [EXACT, PREFIX, FUZZY]]
+
+
+def levenshtein(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def expected_scores(works, title, kinds):
+    """The scores the title matching queries give each work"""
+    title = title.lower()
+    scores = {}
+    for work_id, titles in works.items():
+        for candidate in titles:
+            candidate = candidate.lower()
+            matches = []
+            if EXACT in kinds and candidate == title:
+                matches.append(0)
+            prefix = candidate.startswith(title) or title.startswith(candidate)
+            if PREFIX in kinds and prefix:
+                matches.append(1)
+            if FUZZY in kinds and \
+                    len(candidate.encode('utf-8')) <= FUZZY_MAX_BYTES:
+                distance = levenshtein(candidate, title)
+                if distance <= (len(title) // 3) + 1:
+                    matches.append(distance)
+            if matches:
+                scores[work_id] = min(matches + [scores.get(work_id, 1000)])
+    return scores
+
+
+class TestBoundedLevenshtein(unittest.TestCase):
+
+    def test_against_levenshtein(self):
+        generator = random.Random(0)
+        for _ in range(2000):
+            a = ''.join(generator.choice('abc') for _ in
+                        range(generator.randint(0, 8)))
+            b = ''.join(generator.choice('abc') for _ in
+                        range(generator.randint(0, 8)))
+            limit = generator.randint(0, 4)
+            distance = levenshtein(a, b)
+            self.assertEqual(bounded_levenshtein(a, b, limit),
+                             distance if distance <= limit else None,
+                             (a, b, limit))
+
+
+class TestTitleIndex(unittest.TestCase):
+
+    def index(self, works):
+        index = TitleIndex(ttl=0)
+        index.loaded_at = time.time()
+        for work_id, titles in works.items():
+            index.add(work_id, titles=titles)
+        return index
+
+    def assertScores(self, works, titles):
+        index = self.index(works)
+        for title in titles:
+            for kinds in KINDS:
+                self.assertEqual(index.match(title, kinds),
+                                 expected_scores(works, title, kinds),
+                                 (title, kinds))
+
+    def test_tiers(self):
+        works = {'a': ['Open Access'], 'b': ['Open Access Books'],
+                 'c': ['Open'], 'd': ['Opne Acess'], 'e': ['Closed']}
+        index = self.index(works)
+        self.assertEqual(index.match('open access', [EXACT]), {'a': 0})
+        self.assertEqual(index.match('OPEN ACCESS', [PREFIX]),
+                         {'a': 1, 'b': 1, 'c': 1})
+        # limit: (11 // 3) + 1 = 4
+        self.assertEqual(index.match('open access', [FUZZY]),
+                         {'a': 0, 'd': 3})
+        self.assertEqual(index.match('open access', [EXACT, PREFIX, FUZZY]),
+                         {'a': 0, 'b': 1, 'c': 1, 'd': 3})
+        self.assertScores(works, ['open access', 'open', 'o', 'closed',
+                                  'acess', 'open accesss'])
+
+    def test_limit(self):
+        # limit: (6 // 3) + 1 = 3
+        works = {'three': ['abcxyz'], 'four': ['abwxyz1'],
+                 'shorter': ['abc'], 'longer': ['abcdefghi']}
+        index = self.index(works)
+        self.assertEqual(index.match('abcdef', [FUZZY]),
+                         {'three': 3, 'shorter': 3, 'longer': 3})
+        self.assertScores(works, ['abcdef', 'abc', 'a', 'abcdefghij'])
+
+    def test_short_titles(self):
+        # few bigrams: candidates are taken by length
+        works = {'a': ['a'], 'b': ['b'], 'ab': ['ab'], 'ba': ['ba'],
+                 'abc': ['abc'], 'abcd': ['abcd'], 'x': ['xyzw']}
+        self.assertScores(works, ['a', 'b', 'ab', 'ba', 'c', 'abc', 'xy'])
+
+    def test_repeated_bigrams(self):
+        works = {'a': ['aaaaaaaa'], 'b': ['aaaabaaaa'], 'c': ['abababab'],
+                 'd': ['babababa'], 'e': ['aaaaaaaaaaaa'], 'f': ['aabbaabb']}
+        self.assertScores(works, ['aaaaaaaa', 'aaaaaaaaa', 'abababab',
+                                  'ababab', 'aabbaabbaabb', 'bbbbbbbb'])
+
+    def test_max_bytes(self):
+        # within the limit in characters, but not in bytes
+        long_title = 'é' * (FUZZY_MAX_BYTES // 2 + 1)
+        works = {'long': [long_title], 'short': ['é' * 10]}
+        index = self.index(works)
+        self.assertEqual(index.match(long_title, [FUZZY]), {})
+        self.assertEqual(index.match(long_title, [EXACT]), {'long': 0})
+        self.assertScores(works, [long_title, 'é' * 10, 'é' * 11])
+
+    def test_against_brute_force(self):
+        generator = random.Random(0)
+
+        def text(alphabet, length):
+            return ''.join(generator.choice(alphabet) for _ in range(length))
+
+        works = {}
+        for i in range(200):
+            works[i] = [text('abAB ', generator.randint(1, 14))
+                        for _ in range(generator.randint(1, 2))]
+        titles = [text('abAB ', generator.randint(1, 14)) for _ in range(100)]
+        titles += [generator.choice(works[i]) for i in range(50)]
+        self.assertScores(works, titles)
+
+    def test_remove(self):
+        works = {'a': ['Title', 'Other'], 'b': ['Title']}
+        index = self.index(works)
+        index.remove('a', titles=['Title'])
+        self.assertEqual(index.match('title', [EXACT]), {'b': 0})
+        self.assertEqual(index.match('other', [EXACT]), {'a': 0})
+        index.remove('b')
+        self.assertEqual(index.match('title', [EXACT, PREFIX, FUZZY]), {})
+        self.assertScores({'a': ['Other']}, ['title', 'other', 'othe'])
+
+
+if __name__ == '__main__':
+    unittest.main()
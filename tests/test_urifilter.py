@@ -0,0 +1,55 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+# the database is not connected to by the tested code
+os.environ.setdefault('JWT_DISABLED', 'true')
+for variable in ('IDENTIFIERSDB_HOST', 'IDENTIFIERSDB_USER',
+                 'IDENTIFIERSDB_PASS', 'IDENTIFIERSDB_DB'):
+    os.environ.setdefault(variable, 'test')
+
+from models.snapshot import uri_key  # noqa: E402
+from models.urifilter import BloomFilter  # noqa: E402
+
+
+def keys(prefix, count):
+    return [uri_key('info:doi', '10.%d/%s.%d' % (i % 97, prefix, i))
+            for i in range(count)]
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def assertFilter(self, capacity, error_rate, added):
+        bloom = BloomFilter(capacity, error_rate)
+        for key in added:
+            bloom.add(key)
+        # no false negatives, ever
+        missing = [key for key in added if key not in bloom]
+        self.assertEqual(missing, [])
+        others = keys('other', 20000)
+        false_positives = sum(1 for key in others if key in bloom)
+        return bloom, false_positives / len(others)
+
+    def test_no_false_negatives(self):
+        for capacity in (1, 10, 1000):
+            added = keys('added', capacity) + [uri_key('https', 'ex.org/é')]
+            self.assertFilter(capacity, 0.01, added)
+
+    def test_error_rate(self):
+        for error_rate in (0.1, 0.01, 0.001):
+            _, rate = self.assertFilter(10000, error_rate,
+                                        keys('added', 10000))
+            self.assertLess(rate, error_rate * 1.5, error_rate)
+
+    def test_under_capacity(self):
+        _, rate = self.assertFilter(10000, 0.01, keys('added', 5000))
+        self.assertLess(rate, 0.01)
+
+    def test_over_capacity(self):
+        # more keys than the filter was sized for are still all found
+        self.assertFilter(100, 0.01, keys('added', 5000))
+
+
+if __name__ == '__main__':
+    unittest.main()